@@ -187,7 +187,7 @@ class AzureSearchImportService:
             max_chunk_size = self.max_search_chunk_size
 
         total_uploaded = 0
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
 
         for start in range(0, len(documents), max_chunk_size):
             chunk = documents[start : start + max_chunk_size]
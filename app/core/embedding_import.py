@@ -1,11 +1,15 @@
 import asyncio
+import math
 import time
-from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 from dataclasses import dataclass
 from datetime import datetime, date
 from core.student_embedding import StudentEmbedding
-from database.postgresql import PostgreSQLManager
+from database.postgresql import PostgreSQLManager, UPSERT_EMBEDDING_SQL
+
+# Students per embeddings request when splitting a batch into chunks
+MIN_EMBEDDING_CHUNK = 64
+MAX_EMBEDDING_CHUNK = 2048  # API limit on inputs per request
 
 @dataclass
 class ProcessingStats:
@@ -15,10 +19,11 @@ class ProcessingStats:
     batches_completed: int = 0
 
 class EmbeddingImportService:
-    def __init__(self, max_concurrent_batches=10, max_db_connections=20, thread_pool_size=20):
+    def __init__(self, max_concurrent_batches=10, max_db_connections=20, max_concurrent_embeddings=20):
         self.student_embedding = StudentEmbedding()
         self.max_concurrent_batches = max_concurrent_batches
-        self.thread_pool_size = thread_pool_size
+        self.max_concurrent_embeddings = max_concurrent_embeddings
+        self.embedding_semaphore = asyncio.Semaphore(max_concurrent_embeddings)
         self.db = PostgreSQLManager(max_db_connections)
         self.stats = ProcessingStats()
         print("Initializing EmbeddingImportService...")
@@ -36,55 +41,69 @@ class EmbeddingImportService:
             print(f"Invalid date format: {date_str}")
             return None
     
-    def _generate_embeddings_batch(self, students: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def _build_embedding_result(self, student: Dict[str, Any], embedding: List[float]) -> Dict[str, Any]:
+        """Prepare separate columns for a student whose embedding was generated"""
+        # Parse date properly
+        dob_date = None
+        if student.get('dob') and student.get('dob') != 'NULL':
+            dob_date = self._parse_date(student.get('dob'))
+        
+        return {
+            'student_id': student['student_id'],
+            'embedding': embedding,
+            'dob': dob_date,
+            'postal_code': student.get('postalCode') if student.get('postalCode') != 'NULL' else None,
+            'mincode': student.get('mincode') if student.get('mincode') != 'NULL' else None,
+            'sex_code': student.get('sexCode') if student.get('sexCode') != 'NULL' else None,
+            'success': True
+        }
+    
+    def _build_failed_result(self, student: Dict[str, Any]) -> Dict[str, Any]:
+        """Placeholder result for a student whose embedding could not be generated"""
+        return {
+            'student_id': student['student_id'], 
+            'embedding': None, 
+            'dob': None,
+            'postal_code': None, 
+            'mincode': None,
+            'sex_code': None,
+            'success': False
+        }
+    
+    async def _generate_embeddings_batch(self, students: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Generate embeddings for a batch of students with separate columns"""
+        try:
+            # One embeddings request per chunk, bounded by the embedding semaphore
+            async with self.embedding_semaphore:
+                embeddings = await self.student_embedding.generate_embeddings_async(students)
+        except Exception as e:
+            print(f"Error generating embeddings for chunk of {len(students)} students: {e}")
+            return [self._build_failed_result(student) for student in students]
+        
         results = []
-        for student in students:
-            try:
-                # Generate name-only embedding
-                embedding = self.student_embedding.generate_embedding(student)
-                
-                # Parse date properly
-                dob_date = None
-                if student.get('dob') and student.get('dob') != 'NULL':
-                    dob_date = self._parse_date(student.get('dob'))
-                
-                # Prepare separate columns
-                result = {
-                    'student_id': student['student_id'],
-                    'embedding': embedding,
-                    'dob': dob_date,
-                    'postal_code': student.get('postalCode') if student.get('postalCode') != 'NULL' else None,
-                    'mincode': student.get('mincode') if student.get('mincode') != 'NULL' else None,
-                    'sex_code': student.get('sexCode') if student.get('sexCode') != 'NULL' else None,
-                    'success': True
-                }
-                results.append(result)
-                
-            except Exception as e:
-                print(f"Error generating embedding for student {student.get('student_id')}: {e}")
-                results.append({
-                    'student_id': student['student_id'], 
-                    'embedding': None, 
-                    'dob': None,
-                    'postal_code': None, 
-                    'mincode': None,
-                    'sex_code': None,
-                    'success': False
-                })
+        for student, embedding in zip(students, embeddings):
+            if embedding is None:
+                print(f"Error generating embedding for student {student.get('student_id')}: no name data")
+                results.append(self._build_failed_result(student))
+            else:
+                results.append(self._build_embedding_result(student, embedding))
         return results
     
-    async def _process_students_parallel(self, students: List[Dict[str, Any]], executor: ThreadPoolExecutor) -> List[Dict[str, Any]]:
-        """Process embeddings in parallel with chunking"""
+    async def _process_students_parallel(self, students: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Process embeddings concurrently with chunking"""
         if not students:
             return []
         
-        chunk_size = max(1, len(students) // self.thread_pool_size)
+        # Keep every chunk large enough to amortize the embeddings request
+        target_chunks = min(self.max_concurrent_embeddings, max(1, len(students) // MIN_EMBEDDING_CHUNK))
+        target_chunks = max(target_chunks, math.ceil(len(students) / MAX_EMBEDDING_CHUNK))
+        chunk_size = math.ceil(len(students) / target_chunks)
         chunks = [students[i:i + chunk_size] for i in range(0, len(students), chunk_size)]
         
-        loop = asyncio.get_event_loop()
-        futures = [loop.run_in_executor(executor, self._generate_embeddings_batch, chunk) for chunk in chunks]
-        chunk_results = await asyncio.gather(*futures, return_exceptions=True)
+        chunk_results = await asyncio.gather(
+            *[self._generate_embeddings_batch(chunk) for chunk in chunks],
+            return_exceptions=True
+        )
         
         results = []
         for chunk_result in chunk_results:
@@ -102,54 +121,35 @@ class EmbeddingImportService:
         if not successful_results:
             return 0
         
-        conn = await self.db.get_connection()
+        batch_data = []
+        for result in successful_results:
+            batch_data.append((
+                result['student_id'],
+                result['embedding'],  # binary-encoded by the pgvector codec
+                result['dob'],  # Already converted to date object
+                result['postal_code'], 
+                result['mincode'],
+                result['sex_code'],
+                'A',  # status_code
+                'system',  # create_user
+                'system'   # update_user
+            ))
+        
+        # Borrow a pooled connection; the pool takes it back when the block exits
+        await self.db.create_pool()
         try:
-            # Prepare batch insert/update query with all 5 columns
-            query = """
-                INSERT INTO "api_pen_match_v2".student_embeddings 
-                (student_id, embedding, dob, postal_code, mincode, sex_code, status_code, create_user, update_user)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) 
-                ON CONFLICT (student_id) DO UPDATE SET
-                embedding = EXCLUDED.embedding,
-                dob = EXCLUDED.dob,
-                postal_code = EXCLUDED.postal_code,
-                mincode = EXCLUDED.mincode,
-                sex_code = EXCLUDED.sex_code,
-                update_user = EXCLUDED.update_user, 
-                update_date = now()
-            """
-            
-            batch_data = []
-            for result in successful_results:
-                embedding_str = "[" + ",".join(str(x) for x in result['embedding']) + "]"
-                batch_data.append((
-                    result['student_id'],
-                    embedding_str,
-                    result['dob'],  # Already converted to date object
-                    result['postal_code'], 
-                    result['mincode'],
-                    result['sex_code'],
-                    'A',  # status_code
-                    'system',  # create_user
-                    'system'   # update_user
-                ))
-            
-            await conn.executemany(query, batch_data)
+            async with self.db.connection_pool.acquire() as conn:
+                # Batch insert/update with all 5 columns
+                await conn.executemany(UPSERT_EMBEDDING_SQL, batch_data)
             return len(successful_results)
             
         except Exception as e:
             print(f"Error in batch upsert: {e}")
             return 0
-        finally:
-            await conn.close()
     
-    async def _process_single_batch(self, offset: int, batch_size: int, executor: ThreadPoolExecutor) -> int:
+    async def _process_single_batch(self, students: List[Dict[str, Any]]) -> int:
         """Process single batch with 5-column storage"""
-        students = await self.db.fetch_students_batch(offset, batch_size)
-        if not students:
-            return 0
-        
-        results = await self._process_students_parallel(students, executor)
+        results = await self._process_students_parallel(students)
         processed = await self._batch_upsert_embeddings_with_columns(results)
         
         self.stats.total_processed += processed
@@ -216,7 +216,6 @@ class EmbeddingImportService:
                     
                     # Generate name-only embedding
                     embedding = self.student_embedding.generate_embedding(student)
-                    embedding_str = "[" + ",".join(str(x) for x in embedding) + "]"
                     
                     # Prepare separate column values with proper date conversion
                     dob_val = self._parse_date(student.get('dob')) if student.get('dob') != 'NULL' else None
@@ -225,19 +224,7 @@ class EmbeddingImportService:
                     sex_code_val = student.get('sexCode') if student.get('sexCode') != 'NULL' else None
                     
                     # Insert with all 5 columns: embedding + 4 separate fields
-                    await conn.execute("""
-                        INSERT INTO "api_pen_match_v2".student_embeddings 
-                        (student_id, embedding, dob, postal_code, mincode, sex_code, status_code, create_user, update_user)
-                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) 
-                        ON CONFLICT (student_id) DO UPDATE SET
-                        embedding = EXCLUDED.embedding,
-                        dob = EXCLUDED.dob,
-                        postal_code = EXCLUDED.postal_code,
-                        mincode = EXCLUDED.mincode,
-                        sex_code = EXCLUDED.sex_code,
-                        update_user = EXCLUDED.update_user, 
-                        update_date = now()
-                    """, student_id, embedding_str, dob_val, postal_code_val, mincode_val, sex_code_val, 'A', 'system', 'system')
+                    await conn.execute(UPSERT_EMBEDDING_SQL, student_id, embedding, dob_val, postal_code_val, mincode_val, sex_code_val, 'A', 'system', 'system')
                     
                     processed += 1
                     print(f"Successfully processed student {student_id} with 5 columns:")
@@ -277,32 +264,44 @@ class EmbeddingImportService:
             print("  4. Mincode")
             print("  5. Sex Code")
             
-            with ThreadPoolExecutor(max_workers=self.thread_pool_size) as executor:
-                semaphore = asyncio.Semaphore(self.max_concurrent_batches)
-                
-                async def process_batch_with_semaphore(offset):
-                    async with semaphore:
-                        return await self._process_single_batch(offset, batch_size, executor)
+            # Bounds the batches being embedded/upserted (and held in memory) at once
+            semaphore = asyncio.Semaphore(self.max_concurrent_batches)
+            
+            async def process_batch_with_semaphore(students):
+                try:
+                    return await self._process_single_batch(students)
+                finally:
+                    semaphore.release()
+            
+            total_batches = math.ceil(total_count / batch_size)
+            print(f"Processing {total_batches:,} batches...")
+            
+            # Pages are read in order with keyset pagination (each page starts after the previous
+            # page's last student_id), while earlier pages are still being processed
+            tasks = set()
+            last_student_id = None
+            batches_fetched = 0
+            while True:
+                await semaphore.acquire()
+                students = await self.db.fetch_students_batch(last_student_id, batch_size)
+                if not students:
+                    semaphore.release()
+                    break
                 
-                batch_offsets = list(range(0, total_count, batch_size))
-                total_batches = len(batch_offsets)
-                print(f"Processing {total_batches:,} batches...")
+                last_student_id = students[-1]["student_id"]
+                batches_fetched += 1
+                task = asyncio.create_task(process_batch_with_semaphore(students))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
                 
-                # Process in chunks of 100 batches
-                chunk_size = 100
-                for chunk_start in range(0, total_batches, chunk_size):
-                    chunk_end = min(chunk_start + chunk_size, total_batches)
-                    chunk_offsets = batch_offsets[chunk_start:chunk_end]
-                    
-                    tasks = [process_batch_with_semaphore(offset) for offset in chunk_offsets]
-                    await asyncio.gather(*tasks, return_exceptions=True)
-                    
-                    # Progress update every 50 batches
-                    if self.stats.batches_completed % 50 == 0:
-                        elapsed = time.time() - self.stats.start_time
-                        rate = self.stats.batches_completed / elapsed if elapsed > 0 else 0
-                        print(f"Progress: {self.stats.batches_completed:,}/{total_batches:,} batches "
-                              f"({self.stats.total_processed:,} records, {rate:.1f} batches/sec)")
+                # Progress update every 50 batches
+                if batches_fetched % 50 == 0:
+                    elapsed = time.time() - self.stats.start_time
+                    rate = self.stats.batches_completed / elapsed if elapsed > 0 else 0
+                    print(f"Progress: {self.stats.batches_completed:,}/{total_batches:,} batches "
+                          f"({self.stats.total_processed:,} records, {rate:.1f} batches/sec)")
+            
+            await asyncio.gather(*tasks, return_exceptions=True)
             
             elapsed = time.time() - self.stats.start_time
             print(f"5-Column import completed:")
@@ -390,7 +389,6 @@ class EmbeddingImportService:
                         
                         # Generate name-only embedding
                         embedding = self.student_embedding.generate_embedding(student)
-                        embedding_str = "[" + ",".join(str(x) for x in embedding) + "]"
                         
                         # Prepare separate column values with proper date conversion
                         dob_val = self._parse_date(student.get('dob')) if student.get('dob') != 'NULL' else None
@@ -404,7 +402,7 @@ class EmbeddingImportService:
                             (student_id, embedding, dob, postal_code, mincode, sex_code, status_code, create_user, update_user)
                             VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
                             ON CONFLICT (student_id) DO NOTHING
-                        """, student_id, embedding_str, dob_val, postal_code_val, mincode_val, sex_code_val, 'A', 'system', 'system')
+                        """, student_id, embedding, dob_val, postal_code_val, mincode_val, sex_code_val, 'A', 'system', 'system')
                         
                         processed_for_name += 1
                         print(f"    Successfully processed student {student_id} with 5 columns")
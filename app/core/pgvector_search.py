@@ -1,15 +1,172 @@
 import asyncio
+import logging
+import os
 import time
+import numpy as np
+from dataclasses import dataclass
 from typing import List, Dict, Any, Optional
 from core.student_embedding import StudentEmbedding
 from database.postgresql import PostgreSQLManager
-import difflib
+from rapidfuzz import fuzz
 from datetime import datetime, date
 
+logger = logging.getLogger(__name__)
+
+# Set DEBUG_TOP_CANDIDATES=1 to log the top 10 ranked candidates of every search (needs DEBUG level)
+DEBUG_TOP_CANDIDATES = os.getenv("DEBUG_TOP_CANDIDATES", "").lower() in ("1", "true", "yes")
+
+# (max rows in student_embeddings, hnsw.ef_search) - bigger graphs need a wider candidate list for the same recall
+EF_SEARCH_TIERS = ((10_000, 40), (100_000, 100), (1_000_000, 200))
+DEFAULT_EF_SEARCH = 400
+MAX_EF_SEARCH = 1000  # pgvector upper bound
+
+EMBEDDING_DIMENSIONS = 1536
+HNSW_INDEX_NAME = "student_embeddings_active_halfvec_ip_hnsw_idx"
+# Superseded indexes: full-precision cosine, halfvec cosine, then halfvec inner product over all rows
+LEGACY_HNSW_INDEX_NAMES = (
+    "student_embeddings_hnsw_idx",
+    "student_embeddings_halfvec_hnsw_idx",
+    "student_embeddings_halfvec_ip_hnsw_idx",
+)
+
+# HNSW build settings - the graph must fit in maintenance_work_mem or pgvector falls back to a much slower build
+HNSW_BUILD_MAINTENANCE_WORK_MEM_MB = 2048
+HNSW_BUILD_PARALLEL_WORKERS = 7
+HNSW_LARGE_TABLE_ROWS = 1_000_000
+
+MIN_NAME_SIMILARITY = 0.6  # 60% name similarity minimum
+MAX_RETURNED_CANDIDATES = 50  # only these are materialized as response dicts
+
+@dataclass(frozen=True)
+class SoftScoreWeights:
+    postal: float
+    mincode: float
+    sex: float
+
+# Normal weights when middle name is provided
+WEIGHTS_WITH_MIDDLE_NAME = SoftScoreWeights(postal=0.15, mincode=0.20, sex=0.10)
+# Higher weights when middle name is missing - compensate for embedding difference
+WEIGHTS_WITHOUT_MIDDLE_NAME = SoftScoreWeights(postal=0.25, mincode=0.30, sex=0.15)
+
+STORED_EMBEDDING_SQL = """
+    SELECT se.embedding, s.legal_first_name, s.legal_last_name, s.legal_middle_names
+    FROM "api_pen_match_v2".student_embeddings se
+    JOIN "api_pen_match_v2".student s ON se.student_id = s.student_id
+    WHERE s.pen = $1 AND se.status_code = 'A'
+    LIMIT 1
+"""
+
+# Batch form of STORED_EMBEDDING_SQL: one row per PEN in $1
+STORED_EMBEDDINGS_BY_PEN_SQL = """
+    SELECT DISTINCT ON (s.pen) s.pen, se.embedding, s.legal_first_name, s.legal_last_name, s.legal_middle_names
+    FROM "api_pen_match_v2".student_embeddings se
+    JOIN "api_pen_match_v2".student s ON se.student_id = s.student_id
+    WHERE s.pen = ANY($1::text[]) AND se.status_code = 'A'
+"""
+
+# Candidate columns shared by every search statement:
+# $1 embedding, $2-$4 cleaned postal/mincode/sex for soft scoring
+_CANDIDATE_SELECT_SQL = """
+    SELECT 
+        s.student_id,
+        s.pen,
+        s.legal_first_name,
+        s.legal_last_name,
+        s.legal_middle_names,
+        se.dob,
+        se.sex_code,
+        se.postal_code,
+        se.mincode,
+        COALESCE(LPAD(s.local_id::text, 8, '0'), 'NULL') as local_id,
+        -- Embeddings are unit-norm, so the inner product is the cosine similarity (<#> returns its negative)
+        (-(se.embedding <#> $1::vector)) as embedding_similarity,
+        (1 + (se.embedding <#> $1::vector)) as cosine_distance,
+        -- Exact soft-score components; NULL means Python still has to fuzzy match
+        CASE
+            WHEN $2::text = '' OR COALESCE(se.postal_code, '') = '' THEN 0.0
+            WHEN UPPER(REPLACE(se.postal_code, ' ', '')) = $2::text THEN 1.0
+            WHEN LENGTH($2::text) >= 3 AND LENGTH(REPLACE(se.postal_code, ' ', '')) >= 3
+                 AND LEFT(UPPER(REPLACE(se.postal_code, ' ', '')), 3) = LEFT($2::text, 3) THEN 0.7
+        END::float8 as postal_similarity,
+        CASE
+            WHEN $3::text = '' OR COALESCE(se.mincode::text, '') = '' THEN 0.0
+            WHEN BTRIM(se.mincode::text) = $3::text THEN 1.0
+        END::float8 as mincode_similarity,
+        CASE
+            WHEN $4::text = '' OR COALESCE(se.sex_code, '') = '' THEN 0.0
+            WHEN UPPER(se.sex_code) = $4::text THEN 1.0
+            ELSE 0.0
+        END::float8 as sex_similarity
+    FROM "api_pen_match_v2".student_embeddings se
+    JOIN "api_pen_match_v2".student s ON se.student_id = s.student_id
+"""
+
+# One statement for every query shape so asyncpg prepares it once per connection.
+# $5 DOB filter, $6 sex filter (NULL = not filtered), $7 minimum name similarity, $8 limit
+SEARCH_CANDIDATES_SQL = _CANDIDATE_SELECT_SQL + f"""
+    WHERE se.status_code = 'A'
+      AND ($5::date IS NULL OR se.dob = $5::date)
+      AND ($6::text IS NULL OR se.sex_code = $6::text)
+      AND (-(se.embedding <#> $1::vector)) >= $7::float8
+    -- Order by embedding similarity - expression must match the halfvec index
+    ORDER BY se.embedding::halfvec({EMBEDDING_DIMENSIONS}) <#> $1::vector::halfvec({EMBEDDING_DIMENSIONS}) ASC
+    LIMIT $8::int
+"""
+
+# Every active student with the query's DOB and sex, scored exactly (btree on dob, sex_code, mincode).
+# $5 DOB, $6 sex, $7 limit
+EXACT_FILTER_CANDIDATES_SQL = _CANDIDATE_SELECT_SQL + """
+    WHERE se.status_code = 'A'
+      AND se.dob = $5::date
+      AND se.sex_code = $6::text
+    ORDER BY se.embedding <#> $1::vector ASC
+    LIMIT $7::int
+"""
+
+# The query's own PEN, if it passes the hard filters. $5 PEN, $6 DOB filter, $7 sex filter
+PEN_CANDIDATE_SQL = _CANDIDATE_SELECT_SQL + """
+    WHERE s.pen = $5::text
+      AND se.status_code = 'A'
+      AND ($6::date IS NULL OR se.dob = $6::date)
+      AND ($7::text IS NULL OR se.sex_code = $7::text)
+"""
+
+FILTER_INDEX_NAME = "student_embeddings_dob_sex_mincode_idx"
+
+def _score_batch(postal_sims: np.ndarray, mincode_sims: np.ndarray, sex_sims: np.ndarray,
+                 postal_weight: float, mincode_weight: float, sex_weight: float) -> np.ndarray:
+    """Vectorized soft score for a candidate batch"""
+    return postal_sims * postal_weight + mincode_sims * mincode_weight + sex_sims * sex_weight
+
+def _top_n_stable(scores: np.ndarray, n: int) -> np.ndarray:
+    """Positions of the n highest scores, ordered like a stable descending sort (ties by position)"""
+    if len(scores) > n:
+        # O(len) selection instead of sorting everything; all scores above the n-th largest,
+        # then the earliest of the ties at that value
+        kth_largest = np.partition(scores, len(scores) - n)[len(scores) - n]
+        above = np.flatnonzero(scores > kth_largest)
+        ties = np.flatnonzero(scores == kth_largest)[:n - len(above)]
+        top = np.concatenate((above, ties))
+    else:
+        top = np.arange(len(scores))
+    return top[np.lexsort((top, -scores[top]))]
+
 class PGVectorSearchService:
     def __init__(self):
         self.student_embedding = StudentEmbedding()
-        self.db = PostgreSQLManager()
+        # Sized for concurrent request traffic rather than the import's batch workers
+        self.db = PostgreSQLManager(
+            max_connections=50,
+            min_connections=10,
+            application_name='pen_match_search'
+        )
+        self.ef_search_base = None
+    
+    async def initialize(self):
+        """Open the pool up front so the first searches don't pay connection setup"""
+        await self.db.create_pool()
+        async with self.db.connection_pool.acquire() as conn:
+            await self._load_ef_search_base(conn)
     
     def _parse_date(self, date_str: str) -> Optional[date]:
         """Convert date string to Python date object"""
@@ -22,8 +179,45 @@ class PGVectorSearchService:
         except ValueError:
             return None
     
+    async def _estimate_row_count(self, conn) -> int:
+        """Planner's row estimate for student_embeddings (exact count if the table was never analyzed)"""
+        row_estimate = await conn.fetchval("""
+            SELECT reltuples::bigint 
+            FROM pg_class 
+            WHERE oid = '"api_pen_match_v2".student_embeddings'::regclass
+        """)
+        
+        if row_estimate is None or row_estimate < 0:
+            row_estimate = await conn.fetchval('SELECT COUNT(*) FROM "api_pen_match_v2".student_embeddings')
+        
+        return row_estimate
+    
+    async def _load_ef_search_base(self, conn) -> int:
+        """Pick the baseline hnsw.ef_search from the planner's row estimate for student_embeddings"""
+        if self.ef_search_base is None:
+            row_estimate = await self._estimate_row_count(conn)
+            
+            self.ef_search_base = DEFAULT_EF_SEARCH
+            for max_rows, ef_search in EF_SEARCH_TIERS:
+                if row_estimate <= max_rows:
+                    self.ef_search_base = ef_search
+                    break
+        
+        return self.ef_search_base
+    
+    def _choose_ef_search(self, limit: int, has_hard_filter: bool) -> int:
+        """Smallest ef_search that can still fill the result limit"""
+        ef_search = self.ef_search_base
+        
+        # DOB/sex filters are applied after the HNSW scan, so widen the candidate list to keep recall
+        if has_hard_filter:
+            ef_search *= 2
+        
+        # HNSW returns at most ef_search rows, so it can never drop below the LIMIT
+        return min(max(ef_search, limit), MAX_EF_SEARCH)
+    
     async def create_hnsw_index_if_not_exists(self):
-        """Create HNSW index on embeddings if it doesn't exist"""
+        """Create HNSW index on half-precision embeddings if it doesn't exist"""
         await self.db.create_pool()
         
         try:
@@ -31,287 +225,367 @@ class PGVectorSearchService:
                 check_index_query = """
                     SELECT indexname 
                     FROM pg_indexes 
-                    WHERE tablename = 'student_embeddings' 
-                    AND indexname = 'student_embeddings_hnsw_idx'
+                    WHERE schemaname = 'api_pen_match_v2'
+                    AND tablename = 'student_embeddings' 
+                    AND indexname = $1
                 """
                 
-                existing_index = await conn.fetchval(check_index_query)
+                existing_index = await conn.fetchval(check_index_query, HNSW_INDEX_NAME)
                 
                 if not existing_index:
-                    create_index_query = """
-                        CREATE INDEX CONCURRENTLY student_embeddings_hnsw_idx 
+                    row_count = await self._estimate_row_count(conn)
+                    
+                    # Denser graph for large tables keeps recall up at the same ef_search
+                    if row_count > HNSW_LARGE_TABLE_ROWS:
+                        m, ef_construction = 24, 100
+                    else:
+                        m, ef_construction = 16, 64
+                    
+                    # halfvec element (2 bytes/dim) + neighbour links, with headroom for graph overhead
+                    required_mb = row_count * (EMBEDDING_DIMENSIONS * 2 + m * 8) * 1.5 / (1024 * 1024)
+                    if required_mb > HNSW_BUILD_MAINTENANCE_WORK_MEM_MB:
+                        print(f"Warning: HNSW build for {row_count} rows needs ~{required_mb:.0f} MB but "
+                              f"maintenance_work_mem is {HNSW_BUILD_MAINTENANCE_WORK_MEM_MB} MB; build will spill and run slowly")
+                    
+                    # Session-level SETs: CREATE INDEX CONCURRENTLY can't run inside a transaction
+                    await conn.execute(f"SET maintenance_work_mem = '{HNSW_BUILD_MAINTENANCE_WORK_MEM_MB}MB'")
+                    await conn.execute(f"SET max_parallel_maintenance_workers = {HNSW_BUILD_PARALLEL_WORKERS}")
+                    
+                    # Expression index over halfvec: half the bytes per graph probe, column stays full precision.
+                    # Partial on active rows - inactive students are never searched, so they stay out of the graph
+                    create_index_query = f"""
+                        CREATE INDEX CONCURRENTLY {HNSW_INDEX_NAME} 
                         ON "api_pen_match_v2".student_embeddings 
-                        USING hnsw (embedding vector_cosine_ops) 
-                        WITH (m = 16, ef_construction = 64)
+                        USING hnsw ((embedding::halfvec({EMBEDDING_DIMENSIONS})) halfvec_ip_ops) 
+                        WITH (m = {m}, ef_construction = {ef_construction})
+                        WHERE status_code = 'A'
                     """
                     
-                    await conn.execute(create_index_query)
+                    try:
+                        await conn.execute(create_index_query)
+                    finally:
+                        # Don't hand a 2GB maintenance_work_mem connection back to the pool
+                        await conn.execute("RESET maintenance_work_mem")
+                        await conn.execute("RESET max_parallel_maintenance_workers")
+                    
+                    # Older cosine indexes are no longer used by search_students
+                    for legacy_index in LEGACY_HNSW_INDEX_NAMES:
+                        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "api_pen_match_v2".{legacy_index}')
                     
         except Exception as e:
             print(f"Error managing HNSW index: {e}")
     
-    def _calculate_postal_similarity(self, query_postal: str, candidate_postal: str) -> float:
-        """Calculate postal code similarity with improved matching"""
-        if not query_postal or not candidate_postal:
-            return 0.0
-        
-        query_clean = query_postal.replace(" ", "").upper()
-        candidate_clean = candidate_postal.replace(" ", "").upper()
-        
-        if query_clean == candidate_clean:
-            return 1.0
-        
-        # Check if first 3 characters match (same area)
-        if len(query_clean) >= 3 and len(candidate_clean) >= 3:
-            if query_clean[:3] == candidate_clean[:3]:
-                return 0.7  # Partial match for same area
+    async def create_filter_index_if_not_exists(self):
+        """Create the btree used to scan small DOB + sex groups without the HNSW graph"""
+        await self.db.create_pool()
         
-        # Fuzzy matching for close postal codes
-        similarity = difflib.SequenceMatcher(None, query_clean, candidate_clean).ratio()
+        try:
+            async with self.db.connection_pool.acquire() as conn:
+                await conn.execute(f"""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS {FILTER_INDEX_NAME} 
+                    ON "api_pen_match_v2".student_embeddings (dob, sex_code, mincode)
+                """)
+        except Exception as e:
+            print(f"Error managing filter index: {e}")
+    
+    def _fuzzy_postal_similarity(self, query_clean: str, candidate_clean: str) -> float:
+        """Fuzzy matching for close postal codes (inputs already cleaned, no exact/area match)"""
+        # score_cutoff lets rapidfuzz bail out early on hopeless pairs (returns 0)
+        similarity = fuzz.ratio(query_clean, candidate_clean, score_cutoff=50) / 100.0
         return similarity if similarity > 0.5 else 0.0
     
-    def _calculate_mincode_similarity(self, query_mincode: str, candidate_mincode: str) -> float:
-        """Calculate mincode similarity (exact match preferred)"""
-        if not query_mincode or not candidate_mincode:
-            return 0.0
-        
-        query_clean = str(query_mincode).strip()
-        candidate_clean = str(candidate_mincode).strip()
-        
-        if query_clean == candidate_clean:
-            return 1.0
-        
-        # Partial matching for mincode
-        similarity = difflib.SequenceMatcher(None, query_clean, candidate_clean).ratio()
+    def _fuzzy_mincode_similarity(self, query_clean: str, candidate_clean: str) -> float:
+        """Partial matching for mincode (inputs already cleaned, not equal)"""
+        similarity = fuzz.ratio(query_clean, candidate_clean, score_cutoff=80) / 100.0
         return similarity if similarity > 0.8 else 0.0
     
-    def _calculate_sex_similarity(self, query_sex: str, candidate_sex: str) -> float:
-        """Calculate sex similarity (exact match only)"""
-        if not query_sex or not candidate_sex:
-            return 0.0
-        
-        return 1.0 if query_sex.upper() == candidate_sex.upper() else 0.0
-    
     def _has_middle_name_query(self, query: Dict[str, Any]) -> bool:
         """Check if query has middle name"""
         middle = query.get("legalMiddleNames", "")
         return middle and middle.strip() and middle != 'NULL'
     
-    def _is_reasonable_candidate(self, query: Dict[str, Any], candidate: Dict[str, Any]) -> bool:
-        """Filter for reasonable candidates based on basic criteria"""
-        
-        # Sex filter - if query has sex, candidate must match
-        query_sex = query.get("sexCode", "").upper()
-        candidate_sex = candidate.get("sexCode", "").upper()
-        if query_sex and candidate_sex and query_sex != candidate_sex:
-            return False
-        
-        # Name similarity threshold - embedding similarity must be reasonable
-        if candidate.get("embedding_similarity", 0) < 0.6:  # 60% similarity threshold
-            return False
-        
-        return True
+    def _soft_score_weights(self, has_middle_name: bool) -> SoftScoreWeights:
+        """Pick the soft-score weights for the query"""
+        return WEIGHTS_WITH_MIDDLE_NAME if has_middle_name else WEIGHTS_WITHOUT_MIDDLE_NAME
     
-    def _calculate_soft_score(self, query: Dict[str, Any], candidate: Dict[str, Any]) -> float:
-        """Calculate soft scoring for postal, mincode, sex with increased weights"""
-        soft_score = 0.0
+    @staticmethod
+    def _query_pen(query: Dict[str, Any]) -> Optional[str]:
+        pen = query.get("pen")
+        return str(pen) if pen and pen != 'NULL' else None
+    
+    async def _maybe_reuse_stored_embedding(self, query: Dict[str, Any]) -> Optional[Any]:
+        """Return the stored embedding for the query's PEN when the stored names embed to the same text"""
+        pen = self._query_pen(query)
+        if pen is None:
+            return None
         
-        # Check if query has middle name - if not, increase weights for other fields
-        has_middle_name = self._has_middle_name_query(query)
+        async with self.db.connection_pool.acquire() as conn:
+            row = await conn.fetchrow(STORED_EMBEDDING_SQL, pen)
         
-        if has_middle_name:
-            # Normal weights when middle name is provided
-            postal_weight = 0.15    # Increased from 0.1
-            mincode_weight = 0.20   # Increased from 0.15  
-            sex_weight = 0.10       # Increased from 0.05
-        else:
-            # Higher weights when middle name is missing - compensate for embedding difference
-            postal_weight = 0.25    # Much higher weight
-            mincode_weight = 0.30   # Much higher weight
-            sex_weight = 0.15       # Much higher weight
-        
-        # Postal code similarity
-        postal_sim = self._calculate_postal_similarity(
-            query.get("postalCode", ""),
-            candidate.get("postalCode", "")
-        )
-        soft_score += postal_sim * postal_weight
+        return self._stored_embedding_if_same_names(query, row)
+    
+    async def _reuse_stored_embeddings(self, conn, queries: List[Dict[str, Any]]) -> List[Optional[Any]]:
+        """_maybe_reuse_stored_embedding for a batch, with one lookup for every PEN on the given connection"""
+        pens = {pen for pen in map(self._query_pen, queries) if pen is not None}
+        rows = {}
+        if pens:
+            rows = {row["pen"]: row for row in await conn.fetch(STORED_EMBEDDINGS_BY_PEN_SQL, list(pens))}
         
-        # Mincode similarity  
-        mincode_sim = self._calculate_mincode_similarity(
-            query.get("mincode", ""),
-            candidate.get("mincode", "")
-        )
-        soft_score += mincode_sim * mincode_weight
+        return [self._stored_embedding_if_same_names(query, rows.get(self._query_pen(query))) for query in queries]
+    
+    def _stored_embedding_if_same_names(self, query: Dict[str, Any], row) -> Optional[Any]:
+        if row is None:
+            return None
         
-        # Sex similarity
-        sex_sim = self._calculate_sex_similarity(
-            query.get("sexCode", ""),
-            candidate.get("sexCode", "")
-        )
-        soft_score += sex_sim * sex_weight
+        stored_names = {
+            "legalFirstName": row["legal_first_name"],
+            "legalLastName": row["legal_last_name"],
+            "legalMiddleNames": row["legal_middle_names"]
+        }
+        # A PEN with different (e.g. misspelled) query names must still be embedded as queried
+        if self.student_embedding.student_to_text(stored_names) != self.student_embedding.student_to_text(query):
+            return None
         
-        return soft_score
+        # Already a float32 numpy array via the registered pgvector codec
+        return row["embedding"]
     
     async def search_students(self, query: Dict[str, Any]) -> Dict[str, Any]:
         """
         Hybrid search: Name embedding + soft scoring for other fields
         """
         
-        # Step 1: Generate name embedding
+        # Ensure database connection pool is available
+        if not self.db.connection_pool:
+            await self.db.create_pool()
+        
+        # Step 1: Name embedding - reuse the stored one for a known PEN, otherwise generate it
         embedding_start_time = time.time()
-        query_embedding = self.student_embedding.generate_embedding(query)
+        query_embedding = await self._maybe_reuse_stored_embedding(query)
+        embedding_reused = query_embedding is not None
+        if not embedding_reused:
+            query_embedding = await self.student_embedding.generate_embedding_async(query)
         embedding_time = time.time() - embedding_start_time
         
+        try:
+            async with self.db.connection_pool.acquire() as conn:
+                return await self._search_with_embedding(
+                    conn, query, query_embedding, embedding_reused, embedding_time
+                )
+        
+        except Exception:
+            logger.exception("Error during search")
+            raise
+    
+    async def search_students_many(self, queries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Search several queries with one embeddings request and one pooled connection
+        """
+        
         # Ensure database connection pool is available
         if not self.db.connection_pool:
             await self.db.create_pool()
         
         try:
             async with self.db.connection_pool.acquire() as conn:
-                # Set HNSW search parameters - increase for better recall when middle names missing
-                await conn.execute("SET hnsw.ef_search = 400")  # Increased from 200
-                
-                embedding_str = "[" + ",".join(str(x) for x in query_embedding) + "]"
-                
-                # Step 2: Build SQL query with reasonable filters
-                vector_search_start_time = time.time()
-                
-                base_query = """
-                    SELECT 
-                        s.student_id,
-                        s.pen,
-                        s.legal_first_name,
-                        s.legal_last_name,
-                        s.legal_middle_names,
-                        se.dob,
-                        se.sex_code,
-                        se.postal_code,
-                        se.mincode,
-                        COALESCE(LPAD(s.local_id::text, 8, '0'), 'NULL') as local_id,
-                        (1 - (se.embedding <=> $1::vector)) as embedding_similarity,
-                        (se.embedding <=> $1::vector) as cosine_distance
-                    FROM "api_pen_match_v2".student_embeddings se
-                    JOIN "api_pen_match_v2".student s ON se.student_id = s.student_id
-                    WHERE se.status_code = 'A'
-                """
-                
-                # Apply filters
-                query_params = [embedding_str]
-                param_counter = 2
-                
-                # DOB hard filter if provided
-                if query.get("dob") and query["dob"] != 'NULL':
-                    dob_date = self._parse_date(query["dob"])
-                    if dob_date:
-                        base_query += f" AND se.dob = ${param_counter}"
-                        query_params.append(dob_date)
-                        param_counter += 1
-                
-                # Sex hard filter if provided - get only same sex candidates
-                if query.get("sexCode") and query["sexCode"] != 'NULL':
-                    base_query += f" AND se.sex_code = ${param_counter}"
-                    query_params.append(query["sexCode"].upper())
-                    param_counter += 1
-                
-                # Name similarity filter - only get reasonably similar names
-                base_query += " AND (1 - (se.embedding <=> $1::vector)) >= 0.6"  # 60% name similarity minimum
-                
-                # Increase limit to get more candidates when middle name is missing
-                has_middle_name = self._has_middle_name_query(query)
-                limit = 300 if not has_middle_name else 200  # More candidates when middle name missing
-                
-                # Order by embedding similarity and limit
-                base_query += f"""
-                    ORDER BY se.embedding <=> $1::vector ASC
-                    LIMIT {limit}
-                """
-                
-                candidates_rows = await conn.fetch(base_query, *query_params)
-                vector_search_time = time.time() - vector_search_start_time
-                
-                # Debug: Print candidate count
-                print(f"{len(candidates_rows)} candidates found")
-                
-                # Step 3: Python soft scoring and reasonable filtering
-                scoring_start_time = time.time()
-                scored_candidates = []
-                
-                for row in candidates_rows:
-                    candidate = {
-                        "pen": row["pen"],
-                        "legalFirstName": row["legal_first_name"],
-                        "legalLastName": row["legal_last_name"],
-                        "legalMiddleNames": row["legal_middle_names"],
-                        "dob": str(row["dob"]) if row["dob"] else None,
-                        "sexCode": row["sex_code"],
-                        "postalCode": row["postal_code"],
-                        "mincode": row["mincode"],
-                        "localID": row["local_id"],
-                        "embedding_similarity": float(row["embedding_similarity"]),
-                        "cosine_distance": float(row["cosine_distance"])
-                    }
-                    
-                    # Apply reasonable candidate filter
-                    if not self._is_reasonable_candidate(query, candidate):
-                        continue
-                    
-                    # Calculate soft score for postal, mincode, sex
-                    soft_score = self._calculate_soft_score(query, candidate)
-                    
-                    # Final score = main signal (embedding) + secondary signal (soft score)
-                    final_score = candidate["embedding_similarity"] + soft_score
-                    
-                    candidate["soft_score"] = soft_score
-                    candidate["final_score"] = final_score
-                    candidate["has_middle_name_query"] = has_middle_name
-                    
-                    scored_candidates.append(candidate)
+                # Step 1: Name embeddings - stored ones for known PENs, the rest in a single API request
+                embedding_start_time = time.time()
+                query_embeddings = await self._reuse_stored_embeddings(conn, queries)
+                embeddings_reused = [embedding is not None for embedding in query_embeddings]
                 
-                scoring_time = time.time() - scoring_start_time
+                missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+                if missing:
+                    generated = await self.student_embedding.generate_embeddings_async([queries[i] for i in missing])
+                    for i, embedding in zip(missing, generated):
+                        if embedding is None:
+                            raise ValueError(f"Failed to generate embedding for query {i}: student has no name data")
+                        query_embeddings[i] = embedding
+                # Shared by the whole batch, so every result reports the batch embedding time
+                embedding_time = time.time() - embedding_start_time
                 
-                # Step 4: Final ranking by combined score
-                scored_candidates.sort(key=lambda x: x["final_score"], reverse=True)
-                
-                # Debug: Print top 10 candidates for text debug
-                print(f"\n=== DEBUG: TOP 10 CANDIDATES ===")
-                for i, candidate in enumerate(scored_candidates[:10], 1):
-                    print(f"{i}. {candidate['legalFirstName']} {candidate['legalLastName']} {candidate['legalMiddleNames'] or ''}")
-                    print(f"   Sex: {candidate['sexCode']}, Postal: {candidate['postalCode']}, Final Score: {candidate['final_score']:.4f}")
-                
-                # Calculate total processing time
-                total_time = embedding_time + vector_search_time + scoring_time
-                
-                return {
-                    "query": query,
-                    "has_middle_name_in_query": has_middle_name,
-                    "methodology": {
-                        "step1": "Name embedding generation",
-                        "step2": f"SQL hard filter (DOB/Sex if provided) + vector search (top {limit}) + 60% name similarity",
-                        "step3": "Python reasonable filtering + soft scoring (postal, mincode, sex)",
-                        "step4": "Final ranking (embedding + soft score)"
-                    },
-                    "candidates": scored_candidates,
-                    "total_candidates": len(scored_candidates),
-                    "performance": {
-                        "embedding_time_seconds": round(embedding_time, 4),
-                        "vector_search_time_seconds": round(vector_search_time, 4),
-                        "soft_scoring_time_seconds": round(scoring_time, 4),
-                        "total_processing_time_seconds": round(total_time, 4)
-                    }
-                }
+                return [
+                    await self._search_with_embedding(conn, query, query_embedding, embedding_reused, embedding_time)
+                    for query, query_embedding, embedding_reused in zip(queries, query_embeddings, embeddings_reused)
+                ]
         
-        except Exception as e:
-            print(f"Error during search: {e}")
+        except Exception:
+            logger.exception("Error during batch search")
             raise
+    
+    async def _search_with_embedding(self, conn, query: Dict[str, Any], query_embedding, 
+                                     embedding_reused: bool, embedding_time: float) -> Dict[str, Any]:
+        """Steps 2-4 of the hybrid search for a query whose embedding is already known"""
+        # Cleaned query fields for the SQL soft-score components and the fuzzy fallbacks
+        query_postal = (query.get("postalCode") or "").replace(" ", "").upper()
+        query_mincode = str(query.get("mincode") or "").strip()
+        query_sex = (query.get("sexCode") or "").upper()
+        
+        # DOB hard filter if provided
+        dob_filter = None
+        if query.get("dob") and query["dob"] != 'NULL':
+            dob_filter = self._parse_date(query["dob"])
+        
+        # Sex hard filter if provided - get only same sex candidates
+        sex_filter = None
+        if query.get("sexCode") and query["sexCode"] != 'NULL':
+            sex_filter = query["sexCode"].upper()
+        
+        # Increase limit to get more candidates when middle name is missing
+        has_middle_name = self._has_middle_name_query(query)
+        limit = 300 if not has_middle_name else 200  # More candidates when middle name missing
+        
+        await self._load_ef_search_base(conn)
+        
+        # Step 2: Candidate retrieval - cheapest exact path first, HNSW otherwise
+        vector_search_start_time = time.time()
+        candidates_rows = None
+        ef_search = None
+        
+        # Known PEN whose stored names match the query: it is the candidate, no graph scan needed
+        if embedding_reused:
+            candidates_rows = await conn.fetch(
+                PEN_CANDIDATE_SQL,
+                query_embedding, query_postal, query_mincode, query_sex,
+                self._query_pen(query), dob_filter, sex_filter
+            ) or None
+            search_mode = "pen_exact"
+        
+        # Small DOB + sex group: scoring every member exactly beats HNSW (and has perfect recall)
+        if candidates_rows is None and dob_filter is not None and sex_filter is not None:
+            exact_rows = await conn.fetch(
+                EXACT_FILTER_CANDIDATES_SQL,
+                query_embedding, query_postal, query_mincode, query_sex,
+                dob_filter, sex_filter, limit + 1
+            )
+            if len(exact_rows) <= limit:
+                candidates_rows = exact_rows
+                search_mode = "exact_filter"
+        
+        if candidates_rows is None:
+            # HNSW search parameter - sized to the table, the limit and the hard filters
+            ef_search = self._choose_ef_search(
+                limit, has_hard_filter=dob_filter is not None or sex_filter is not None
+            )
+            
+            async with conn.transaction():
+                # SET LOCAL semantics: ef_search ends with the transaction instead of sticking to the pooled connection
+                await conn.execute("SELECT set_config('hnsw.ef_search', $1, true)", str(ef_search))
+                candidates_rows = await conn.fetch(
+                    SEARCH_CANDIDATES_SQL,
+                    query_embedding, query_postal, query_mincode, query_sex,
+                    dob_filter, sex_filter, MIN_NAME_SIMILARITY, limit
+                )
+            search_mode = "hnsw"
+        vector_search_time = time.time() - vector_search_start_time
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%d candidates found (%s)", len(candidates_rows), search_mode)
+        
+        # Step 3: Score the whole batch as numpy columns, fuzzy matching only rows SQL couldn't settle
+        scoring_start_time = time.time()
+        weights = self._soft_score_weights(has_middle_name)
+        row_count = len(candidates_rows)
+        
+        embedding_sims = np.fromiter(
+            (row["embedding_similarity"] for row in candidates_rows), dtype=np.float64, count=row_count
+        )
+        postal_sims = np.fromiter(
+            (row["postal_similarity"] if row["postal_similarity"] is not None
+             else self._fuzzy_postal_similarity(query_postal, row["postal_code"].replace(" ", "").upper())
+             for row in candidates_rows),
+            dtype=np.float64, count=row_count
+        )
+        mincode_sims = np.fromiter(
+            (row["mincode_similarity"] if row["mincode_similarity"] is not None
+             else self._fuzzy_mincode_similarity(query_mincode, str(row["mincode"]).strip())
+             for row in candidates_rows),
+            dtype=np.float64, count=row_count
+        )
+        sex_sims = np.fromiter(
+            (row["sex_similarity"] for row in candidates_rows), dtype=np.float64, count=row_count
+        )
+        # Unreasonable candidates: both sexes known and different (or name similarity too low, below)
+        sex_conflicts = np.fromiter(
+            (bool(query_sex and row["sex_code"] and row["sex_code"].upper() != query_sex)
+             for row in candidates_rows),
+            dtype=bool, count=row_count
+        )
+        
+        soft_scores = _score_batch(
+            postal_sims, mincode_sims, sex_sims,
+            weights.postal, weights.mincode, weights.sex
+        )
+        final_scores = embedding_sims + soft_scores
+        
+        # Step 4: Final ranking by combined score (ties keep vector-search order)
+        reasonable = np.flatnonzero((embedding_sims >= MIN_NAME_SIMILARITY) & ~sex_conflicts)
+        ranked = reasonable[_top_n_stable(final_scores[reasonable], MAX_RETURNED_CANDIDATES)]
+        
+        scored_candidates = []
+        for i in ranked.tolist():
+            row = candidates_rows[i]
+            scored_candidates.append({
+                "pen": row["pen"],
+                "legalFirstName": row["legal_first_name"],
+                "legalLastName": row["legal_last_name"],
+                "legalMiddleNames": row["legal_middle_names"],
+                "dob": str(row["dob"]) if row["dob"] else None,
+                "sexCode": row["sex_code"],
+                "postalCode": row["postal_code"],
+                "mincode": row["mincode"],
+                "localID": row["local_id"],
+                "embedding_similarity": float(embedding_sims[i]),
+                "cosine_distance": float(row["cosine_distance"]),
+                "soft_score": float(soft_scores[i]),
+                "final_score": float(final_scores[i]),
+                "has_middle_name_query": has_middle_name
+            })
+        
+        scoring_time = time.time() - scoring_start_time
+        
+        # Top 10 candidates for text debug
+        if DEBUG_TOP_CANDIDATES and logger.isEnabledFor(logging.DEBUG):
+            for i, candidate in enumerate(scored_candidates[:10], 1):
+                logger.debug(
+                    "%d. %s %s %s | Sex: %s, Postal: %s, Final Score: %.4f",
+                    i, candidate['legalFirstName'], candidate['legalLastName'],
+                    candidate['legalMiddleNames'] or '', candidate['sexCode'],
+                    candidate['postalCode'], candidate['final_score']
+                )
+        
+        # Calculate total processing time
+        total_time = embedding_time + vector_search_time + scoring_time
+        
+        return {
+            "query": query,
+            "has_middle_name_in_query": has_middle_name,
+            "methodology": {
+                "step1": "Name embedding generation",
+                "step2": f"SQL hard filter (DOB/Sex if provided) + {search_mode} candidate search (top {limit}) + 60% name similarity",
+                "step3": "SQL exact soft-score components + Python fuzzy fallback (postal, mincode)",
+                "step4": "Final ranking (embedding + soft score)"
+            },
+            "candidates": scored_candidates,
+            "total_candidates": len(reasonable),
+            "performance": {
+                "embedding_time_seconds": round(embedding_time, 4),
+                "embedding_reused": embedding_reused,
+                "vector_search_time_seconds": round(vector_search_time, 4),
+                "soft_scoring_time_seconds": round(scoring_time, 4),
+                "search_mode": search_mode,
+                "hnsw_ef_search": ef_search,
+                "total_processing_time_seconds": round(total_time, 4)
+            }
+        }
 
 # Test example
 if __name__ == "__main__":
     async def test():
         service = PGVectorSearchService()
+        await service.initialize()
         
         # Create HNSW index if needed
         await service.create_hnsw_index_if_not_exists()
+        await service.create_filter_index_if_not_exists()
         
         # Test with sample query - Name and Sex filtering
         query = {
@@ -1,6 +1,35 @@
+import hashlib
+from functools import lru_cache
 import numpy as np
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
 from config.settings import settings
+from core.cache import LRUCache
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+MAX_INPUTS_PER_REQUEST = 2048
+
+# Process-wide cache of name text -> float32 embedding, shared by every StudentEmbedding
+_embedding_cache = LRUCache(maxsize=10000)
+
+def _cache_key(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def _name_field(student, key):
+    """Name value, or "" when missing or the literal 'NULL' placeholder"""
+    value = student.get(key)
+    return value if value and value != 'NULL' else ""
+
+@lru_cache(maxsize=10000)
+def _name_text(first, last, middle):
+    """Embedding text for a name; repeated names (common in imports) are formatted once"""
+    parts = []
+    if first:
+        parts.append(f"First name: {first}.")
+    if last:
+        parts.append(f"Last name: {last}.")
+    if middle:
+        parts.append(f"Middle name: {middle}.")
+    return " ".join(parts)
 
 class StudentEmbedding:
     def __init__(self):
@@ -11,44 +40,111 @@ class StudentEmbedding:
                 api_version="2023-05-15",
                 azure_endpoint=settings.openai_api_base_embedding
             )
+            self.async_openai_client = AsyncAzureOpenAI(
+                api_key=settings.openai_api_key,
+                api_version="2023-05-15",
+                azure_endpoint=settings.openai_api_base_embedding
+            )
         else:
             self.openai_client = OpenAI(api_key=settings.openai_api_key)
+            self.async_openai_client = AsyncOpenAI(api_key=settings.openai_api_key)
 
     def student_to_text(self, student):
         """Convert ONLY student name data to text for embedding"""
-        parts = []
+        # ONLY embed names - other fields will be stored as separate columns
+        return _name_text(
+            _name_field(student, "legalFirstName"),
+            _name_field(student, "legalLastName"),
+            _name_field(student, "legalMiddleNames")
+        )
+
+    def _lookup_cached(self, texts):
+        """Split texts into cached embeddings and the unique texts that still need an API call"""
+        embeddings = [None] * len(texts)
+        missing = {}
+        for i, text in enumerate(texts):
+            # The embeddings endpoint rejects empty strings, so students without names stay None
+            if not text:
+                continue
+            cached = _embedding_cache.get(_cache_key(text))
+            if cached is not None:
+                embeddings[i] = cached.tolist()
+            else:
+                missing.setdefault(text, []).append(i)
+        return embeddings, missing
+
+    def _store_embeddings(self, embeddings, missing, texts, response_data):
+        """Populate the cache and the result list from an embeddings response"""
+        for text, item in zip(texts, response_data):
+            vector = np.asarray(item.embedding, dtype=np.float32)
+            # Unit-normalize so pgvector can rank by inner product instead of cosine
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector /= norm
+            _embedding_cache.put(_cache_key(text), vector)
+            for i in missing[text]:
+                embeddings[i] = vector.tolist()
+
+    def generate_embeddings_for_texts(self, texts):
+        """Embed texts, serving repeats from the cache and batching misses per request"""
+        embeddings, missing = self._lookup_cached(texts)
+        pending = list(missing)
         
-        # First name
-        if student.get("legalFirstName") and student["legalFirstName"] != 'NULL':
-            parts.append(f"First name: {student['legalFirstName']}.")
+        for start in range(0, len(pending), MAX_INPUTS_PER_REQUEST):
+            chunk = pending[start:start + MAX_INPUTS_PER_REQUEST]
+            try:
+                response = self.openai_client.embeddings.create(
+                    input=chunk,
+                    model=EMBEDDING_MODEL
+                )
+            except Exception as e:
+                raise ValueError(f"Failed to generate embeddings: {str(e)}")
+            self._store_embeddings(embeddings, missing, chunk, response.data)
         
-        # Last name
-        if student.get("legalLastName") and student["legalLastName"] != 'NULL':
-            parts.append(f"Last name: {student['legalLastName']}.")
+        return embeddings
+
+    async def generate_embeddings_for_texts_async(self, texts):
+        """Async variant of generate_embeddings_for_texts"""
+        embeddings, missing = self._lookup_cached(texts)
+        pending = list(missing)
         
-        # Middle name
-        if student.get("legalMiddleNames") and student["legalMiddleNames"] != 'NULL':
-            parts.append(f"Middle name: {student['legalMiddleNames']}.")
+        for start in range(0, len(pending), MAX_INPUTS_PER_REQUEST):
+            chunk = pending[start:start + MAX_INPUTS_PER_REQUEST]
+            try:
+                response = await self.async_openai_client.embeddings.create(
+                    input=chunk,
+                    model=EMBEDDING_MODEL
+                )
+            except Exception as e:
+                raise ValueError(f"Failed to generate embeddings: {str(e)}")
+            self._store_embeddings(embeddings, missing, chunk, response.data)
         
-        # ONLY embed names - other fields will be stored as separate columns
-        return " ".join(parts)
+        return embeddings
 
     def generate_embedding(self, student):
         """Generate embedding for student names only"""
-        text = self.student_to_text(student)
-        
-        try:
-            response = self.openai_client.embeddings.create(
-                input=text,
-                model="text-embedding-ada-002"
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            raise ValueError(f"Failed to generate embedding: {str(e)}")
+        embedding = self.generate_embeddings_for_texts([self.student_to_text(student)])[0]
+        if embedding is None:
+            raise ValueError("Failed to generate embedding: student has no name data")
+        return embedding
+
+    async def generate_embedding_async(self, student):
+        """Generate embedding for student names only without blocking the event loop"""
+        embeddings = await self.generate_embeddings_for_texts_async([self.student_to_text(student)])
+        if embeddings[0] is None:
+            raise ValueError("Failed to generate embedding: student has no name data")
+        return embeddings[0]
+
+    async def generate_embeddings_async(self, students):
+        """Generate name-only embeddings for many students in a single API request"""
+        return await self.generate_embeddings_for_texts_async(
+            [self.student_to_text(student) for student in students]
+        )
 
-    def prepare_student_data(self, student):
+    def prepare_student_data(self, student, embedding=None):
         """Prepare student data with embedding and separate columns"""
-        embedding = self.generate_embedding(student)
+        if embedding is None:
+            embedding = self.generate_embedding(student)
         
         return {
             "pen": student.get("pen"),
@@ -70,14 +166,26 @@ class StudentEmbedding:
             }
         }
 
-    def generate_embeddings_batch(self, students):
-        """Generate embeddings for multiple students with separate columns"""
+    def _prepare_batch(self, students, vectors):
+        """Key prepared student data by PEN for students that have a PEN"""
         embeddings = {}
-        for student in students:
-            pen = student.get("pen")
-            if pen:
-                embeddings[pen] = self.prepare_student_data(student)
+        for student, vector in zip(students, vectors):
+            if vector is None:
+                raise ValueError(f"Failed to generate embedding for PEN {student['pen']}: student has no name data")
+            embeddings[student["pen"]] = self.prepare_student_data(student, vector)
         return embeddings
+
+    def generate_embeddings_batch(self, students):
+        """Generate embeddings for multiple students with separate columns"""
+        students = [student for student in students if student.get("pen")]
+        vectors = self.generate_embeddings_for_texts([self.student_to_text(student) for student in students])
+        return self._prepare_batch(students, vectors)
+
+    async def generate_embeddings_batch_async(self, students):
+        """Async variant of generate_embeddings_batch"""
+        students = [student for student in students if student.get("pen")]
+        vectors = await self.generate_embeddings_for_texts_async([self.student_to_text(student) for student in students])
+        return self._prepare_batch(students, vectors)
     
 if __name__ == "__main__":
     try:
@@ -1,8 +1,22 @@
-from sklearn.metrics.pairwise import cosine_similarity
+import asyncio
+import copy
+from collections import deque
 import numpy as np
 from database.student_api import StudentAPI
+from core.cache import LRUCache
 from core.student_embedding import StudentEmbedding
-from database.cosmos_client import CosmosDBClient
+from database.cosmos_client import CosmosDBClient, EMBEDDING_VERSION, STUDENT_FIELD_NAMES
+
+# Scored candidates returned when there is no perfect match
+MAX_CANDIDATES = 10
+
+# Repeated lookups (agent retries, UI refreshes) of names already in Cosmos DB are answered
+# from memory for a few minutes
+QUERY_CACHE_TTL_SECONDS = 300
+_query_cache = LRUCache(maxsize=10000, ttl=QUERY_CACHE_TTL_SECONDS)
+
+# Source API pages requested ahead of the page being embedded during bulk import
+PAGE_PREFETCH_WINDOW = 8
 
 class StudentWorkflow:
     def __init__(self):
@@ -10,6 +24,7 @@ class StudentWorkflow:
         self.embedding_service = StudentEmbedding()
         self.cosmos_client = CosmosDBClient()
         self.similarity_threshold = 0.95  # Threshold for perfect match
+        self._candidate_buffer = np.empty((0, 0), dtype=np.float32)
 
     def create_embeddings_for_students(self, students):
         """Create embeddings and store in Cosmos DB"""
@@ -24,24 +39,57 @@ class StudentWorkflow:
         print(f"Successfully stored {len(results)} student embeddings")
         return results
 
-    def find_perfect_match(self, query_student, candidates):
-        """Find perfect match using embedding similarity"""
-        query_embedding = self.embedding_service.generate_embedding(query_student)
-        query_vec = np.array(query_embedding).reshape(1, -1)
+    def _candidate_matrix(self, candidates):
+        """Copy candidate embeddings into a reused float32 buffer (grown only when too small)"""
+        rows, dims = len(candidates), len(candidates[0]["embedding"])
+        if self._candidate_buffer.shape[0] < rows or self._candidate_buffer.shape[1] != dims:
+            self._candidate_buffer = np.empty((max(rows, self._candidate_buffer.shape[0]), dims), dtype=np.float32)
         
-        best_match = None 
-        best_score = 0
+        matrix = self._candidate_buffer[:rows]
+        for i, candidate in enumerate(candidates):
+            matrix[i] = candidate["embedding"]
+        return matrix
+
+    def _score_candidates(self, query_embedding, candidates):
+        """Cosine similarity of every candidate in one matrix-vector product"""
+        query_vec = np.asarray(query_embedding, dtype=np.float32)
+        query_vec /= np.linalg.norm(query_vec) or 1.0
+        candidate_matrix = self._candidate_matrix(candidates)
         
-        for candidate in candidates:
-            candidate_vec = np.array(candidate["embedding"]).reshape(1, -1)
-            score = cosine_similarity(query_vec, candidate_vec)[0][0]
-            
-            if score > best_score:
-                best_score = score
-                best_match = candidate
+        # Current documents are stored unit-normalized; only legacy ones still need it
+        legacy = np.fromiter(
+            (candidate.get("embeddingVersion", 1) < EMBEDDING_VERSION for candidate in candidates),
+            dtype=bool, count=len(candidates)
+        )
+        if legacy.any():
+            norms = np.linalg.norm(candidate_matrix[legacy], axis=1, keepdims=True)
+            candidate_matrix[legacy] /= np.where(norms == 0, 1.0, norms)
+        
+        return candidate_matrix @ query_vec
+
+    def rank_candidates(self, query_embedding, candidates, limit=MAX_CANDIDATES):
+        """Most similar candidates first, shaped like Cosmos vector search results"""
+        if not candidates:
+            return []
+        
+        scores = self._score_candidates(query_embedding, candidates)
+        top = np.arange(len(scores))
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        
+        return [
+            {**{field: candidates[i].get(field) for field in STUDENT_FIELD_NAMES}, "similarityScore": float(scores[i])}
+            for i in top
+        ]
+
+    def evaluate_closest_match(self, closest):
+        """Apply the perfect match threshold to the best candidate found by Cosmos vector search"""
+        best_score = closest[0]["similarityScore"] if closest else 0
         
         # Check if it's a perfect match
-        if best_score >= self.similarity_threshold:
+        if closest and best_score >= self.similarity_threshold:
+            best_match = {key: value for key, value in closest[0].items() if key != "similarityScore"}
             print(f"Perfect match found with score: {best_score}")
             return best_match, best_score
         
@@ -49,6 +97,20 @@ class StudentWorkflow:
         return None, best_score
 
     def process_student_query(self, query_student):
+        """Main workflow for processing student query, caching Cosmos DB answers per name"""
+        cache_key = self.embedding_service.student_to_text(query_student)
+        result = _query_cache.get(cache_key)
+        if result is None:
+            result = self._process_student_query(query_student)
+            # Only answers served from Cosmos DB are cached: misses and fresh imports from the
+            # source system must be re-checked, since students can be created there at any time
+            if result.get("source") != "cosmos_db":
+                return result
+            _query_cache.put(cache_key, result)
+        # Callers get their own copy so they can't modify the shared cache entry
+        return copy.deepcopy(result)
+
+    def _process_student_query(self, query_student):
         """Main workflow for processing student query"""
         first_name = query_student.get("legalFirstName")
         last_name = query_student.get("legalLastName")
@@ -58,15 +120,18 @@ class StudentWorkflow:
         
         print(f"Processing query for: {first_name} {last_name}")
         
-        # Step 1: Check if name exists in Cosmos DB
-        if self.cosmos_client.name_exists(first_name, last_name):
-            print("Name found in Cosmos DB, fetching candidates")
-            
-            # Fetch candidates from Cosmos
-            candidates = self.cosmos_client.get_students_by_name(first_name, last_name)
+        query_embedding = self.embedding_service.generate_embedding(query_student)
+        
+        # Step 1: Closest stored students with this name; none means the name isn't in Cosmos DB yet
+        closest = self.cosmos_client.get_closest_students_by_name(
+            first_name, last_name, query_embedding, limit=MAX_CANDIDATES
+        )
+        
+        if closest:
+            print("Name found in Cosmos DB")
             
             # Find perfect match
-            perfect_match, score = self.find_perfect_match(query_student, candidates)
+            perfect_match, score = self.evaluate_closest_match(closest)
             
             if perfect_match:
                 return {
@@ -76,9 +141,10 @@ class StudentWorkflow:
                     "source": "cosmos_db"
                 }
             else:
+                # Nearest candidates, most similar first, each with its similarityScore
                 return {
                     "status": "no_perfect_match",
-                    "candidates": candidates,
+                    "candidates": closest,
                     "best_score": score,
                     "source": "cosmos_db",
                     "next_action": "further_analysis_needed"
@@ -97,11 +163,15 @@ class StudentWorkflow:
                 }
             
             # Step 3: Create embeddings and store in Cosmos
-            self.create_embeddings_for_students(source_students)
+            stored = self.create_embeddings_for_students(source_students)
             
-            # Step 4: Fetch from Cosmos and find match
-            candidates = self.cosmos_client.get_students_by_name(first_name, last_name)
-            perfect_match, score = self.find_perfect_match(query_student, candidates)
+            # Step 4: Score the documents just stored instead of reading them back from Cosmos
+            stored = [
+                document for document in stored
+                if document.get("legalFirstName") == first_name and document.get("legalLastName") == last_name
+            ]
+            closest = self.rank_candidates(query_embedding, stored)
+            perfect_match, score = self.evaluate_closest_match(closest)
             
             if perfect_match:
                 return {
@@ -113,7 +183,7 @@ class StudentWorkflow:
             else:
                 return {
                     "status": "no_perfect_match",
-                    "candidates": candidates,
+                    "candidates": closest,
                     "best_score": score,
                     "source": "source_database_then_cosmos",
                     "next_action": "further_analysis_needed"
@@ -121,34 +191,76 @@ class StudentWorkflow:
 
     def bulk_import_students(self, page_size=100, max_pages=None):
         """Bulk import students from source to Cosmos DB"""
+        return asyncio.run(self.bulk_import_students_async(page_size=page_size, max_pages=max_pages))
+
+    async def bulk_import_students_async(self, page_size=100, max_pages=None):
+        """
+        Pipelined bulk import: the next PAGE_PREFETCH_WINDOW pages are fetched while page N
+        is embedded, and page N is written to Cosmos while page N+1 is embedded
+        """
         page = 1
         total_imported = 0
+        pending_insert = None
+        prefetched = deque()
+        next_page_number = 1
+        last_page_seen = False
         
-        while True:
-            if max_pages and page > max_pages:
-                break
-                
+        def fetch_ahead():
+            nonlocal next_page_number
+            while (len(prefetched) < PAGE_PREFETCH_WINDOW and not last_page_seen
+                   and not (max_pages and next_page_number > max_pages)):
+                # Blocking HTTP client - run it off the event loop
+                prefetched.append(asyncio.create_task(
+                    asyncio.to_thread(self.student_api.get_student_page, page=next_page_number, size=page_size)
+                ))
+                next_page_number += 1
+        
+        fetch_ahead()
+        
+        while prefetched:
             print(f"Processing page {page}")
-            students = self.student_api.get_student_page(page=page, size=page_size)
+            students = await prefetched.popleft()
             
             if not students:
                 print("No more students to process")
                 break
             
+            # A short page is the last one, so stop requesting pages past it
+            last_page_seen = len(students) < page_size
+            fetch_ahead()
+            
             # Filter students that don't exist in Cosmos
-            new_students = []
-            for student in students:
-                pen = student.get("pen")
-                if pen and not self.cosmos_client.get_student_by_pen(pen):
-                    new_students.append(student)
+            existing_pens = await asyncio.to_thread(
+                self.cosmos_client.get_existing_pens,
+                [student["pen"] for student in students if student.get("pen")]
+            )
+            new_students = [
+                student for student in students
+                if student.get("pen") and student["pen"] not in existing_pens
+            ]
             
             if new_students:
-                self.create_embeddings_for_students(new_students)
+                print(f"Creating embeddings for {len(new_students)} students")
+                embeddings = await self.embedding_service.generate_embeddings_batch_async(new_students)
+                
+                # Keep at most one page of inserts in flight
+                if pending_insert is not None:
+                    await pending_insert
+                pending_insert = asyncio.create_task(
+                    asyncio.to_thread(self.cosmos_client.batch_insert_embeddings, embeddings)
+                )
                 total_imported += len(new_students)
                 print(f"Imported {len(new_students)} new students from page {page}")
             
+            if last_page_seen:
+                break
             page += 1
         
+        for task in prefetched:
+            task.cancel()
+        if pending_insert is not None:
+            await pending_insert
+        
         print(f"Bulk import completed. Total imported: {total_imported}")
         return total_imported
 
@@ -1,14 +1,60 @@
 from azure.cosmos import CosmosClient, PartitionKey
-from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
 from config.settings import settings
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import json
+import threading
+
+# Stored on each document; version 2+ embeddings are unit-normalized at write time
+EMBEDDING_VERSION = 2
+EMBEDDING_DIMENSIONS = 1536
+
+# Concurrent writes in batch_insert_embeddings; every PEN is its own partition so they don't contend
+BATCH_INSERT_WORKERS = 16
+
+# Lets Cosmos compute similarity server-side (VectorDistance) so embeddings needn't be downloaded
+VECTOR_EMBEDDING_POLICY = {
+    "vectorEmbeddings": [
+        {
+            "path": "/embedding",
+            "dataType": "float32",
+            "distanceFunction": "cosine",
+            "dimensions": EMBEDDING_DIMENSIONS
+        }
+    ]
+}
+
+# Student fields returned to callers; leaves out the ~30KB embedding array per document
+STUDENT_FIELD_NAMES = ("id", "pen", "legalFirstName", "legalMiddleNames", "legalLastName", "dob", "localID")
+STUDENT_FIELDS = ", ".join(f"c.{field}" for field in STUDENT_FIELD_NAMES)
+
+@lru_cache(maxsize=1)
+def _get_cosmos_client(endpoint, key):
+    """One CosmosClient per process so every CosmosDBClient shares its HTTP connection pool"""
+    return CosmosClient(endpoint, key, consistency_level="Session")
+
+# Database/container proxies per (endpoint, database, container), so setup round trips run once per process
+_setup_lock = threading.Lock()
+_setup_cache = {}
 
 class CosmosDBClient:
     def __init__(self):
-        self.client = CosmosClient(settings.cosmos_endpoint, settings.cosmos_key)
+        self.client = _get_cosmos_client(settings.cosmos_endpoint, settings.cosmos_key)
         self.database_name = "student_embeddings"
         self.container_name = "student_records"
-        self._setup_database()
+        self._setup_database_once()
+
+    def _setup_key(self):
+        return (settings.cosmos_endpoint, self.database_name, self.container_name)
+
+    def _setup_database_once(self):
+        """Run _setup_database for the first client in the process; later clients reuse its proxies"""
+        with _setup_lock:
+            if self._setup_key() not in _setup_cache:
+                self._setup_database()
+                _setup_cache[self._setup_key()] = (self.database, self.container)
+            self.database, self.container = _setup_cache[self._setup_key()]
 
     def _setup_database(self):
         """Setup database and container with proper indexing"""
@@ -30,13 +76,20 @@ class CosmosDBClient:
                     {"path": "/legalFirstName", "order": "ascending"},
                     {"path": "/legalLastName", "order": "ascending"}
                 ]
+            ],
+            # Name filters leave a handful of candidates, so an exact (flat) scan over them is enough
+            "vectorIndexes": [
+                {"path": "/embedding", "type": "quantizedFlat"}
             ]
         }
         
+        # Vector policies only apply to newly created containers; existing ones keep working
+        # because queries pass the distance options explicitly
         self.container = self.database.create_container_if_not_exists(
             id=self.container_name,
             partition_key=PartitionKey(path="/pen"),
-            indexing_policy=indexing_policy
+            indexing_policy=indexing_policy,
+            vector_embedding_policy=VECTOR_EMBEDDING_POLICY
         )
 
     def insert_student_embedding(self, student_data, embedding):
@@ -50,19 +103,19 @@ class CosmosDBClient:
             "dob": student_data.get("dob", ""),
             "localID": student_data.get("localID", ""),
             "embedding": embedding,
+            "embeddingVersion": EMBEDDING_VERSION,
             "name_key": f"{student_data.get('legalFirstName', '')}_{student_data.get('legalLastName', '')}"
         }
         
-        try:
-            return self.container.create_item(body=document)
-        except CosmosResourceExistsError:
-            # If item already exists, replace it
-            return self.container.replace_item(item=document["id"], body=document)
+        # Upsert creates or replaces in one round trip, instead of a failed create followed by a replace
+        return self.container.upsert_item(body=document)
 
-    def get_students_by_name(self, first_name, last_name):
-        """Get ALL students by first and last name using pagination"""
-        query = """
-        SELECT * FROM c 
+    def iter_students_by_name(self, first_name, last_name, include_embedding=True):
+        """Yield students by first and last name, fetching pages only as the caller consumes them"""
+        # Embeddings dominate payload size and JSON decode time, so skip them when not scoring
+        fields = "*" if include_embedding else STUDENT_FIELDS
+        query = f"""
+        SELECT {fields} FROM c 
         WHERE c.legalFirstName = @first_name 
         AND c.legalLastName = @last_name
         """
@@ -71,8 +124,6 @@ class CosmosDBClient:
             {"name": "@last_name", "value": last_name}
         ]
         
-        # Use pagination to get ALL results without limit
-        all_students = []
         query_iterator = self.container.query_items(
             query=query,
             parameters=parameters,
@@ -80,12 +131,35 @@ class CosmosDBClient:
             max_item_count=100  # Process in chunks of 100
         )
         
-        # Iterate through all pages to get complete results
         for page in query_iterator.by_page():
-            page_items = list(page)
-            all_students.extend(page_items)
+            yield from page
+
+    def get_students_by_name(self, first_name, last_name, include_embedding=True):
+        """Get ALL students by first and last name using pagination"""
+        return list(self.iter_students_by_name(first_name, last_name, include_embedding))
+
+    def get_closest_students_by_name(self, first_name, last_name, embedding, limit=1):
+        """Students with this first and last name, most similar first, scored by Cosmos (embeddings not returned)"""
+        query = f"""
+        SELECT TOP @limit {STUDENT_FIELDS},
+            VectorDistance(c.embedding, @embedding, false, {{'distanceFunction': 'cosine', 'dataType': 'float32'}}) AS similarityScore
+        FROM c 
+        WHERE c.legalFirstName = @first_name 
+        AND c.legalLastName = @last_name
+        ORDER BY VectorDistance(c.embedding, @embedding, false, {{'distanceFunction': 'cosine', 'dataType': 'float32'}})
+        """
+        parameters = [
+            {"name": "@first_name", "value": first_name},
+            {"name": "@last_name", "value": last_name},
+            {"name": "@embedding", "value": list(embedding)},
+            {"name": "@limit", "value": limit}
+        ]
         
-        return all_students
+        return list(self.container.query_items(
+            query=query,
+            parameters=parameters,
+            enable_cross_partition_query=True
+        ))
 
     def get_student_by_pen(self, pen):
         """Get student by PEN"""
@@ -94,11 +168,25 @@ class CosmosDBClient:
         except CosmosResourceNotFoundError:
             return None
 
+    def get_existing_pens(self, pens):
+        """Return the subset of PENs already stored, in one query instead of a read per PEN"""
+        if not pens:
+            return set()
+        
+        query = "SELECT VALUE c.pen FROM c WHERE ARRAY_CONTAINS(@pens, c.pen)"
+        parameters = [{"name": "@pens", "value": list(pens)}]
+        
+        return set(self.container.query_items(
+            query=query,
+            parameters=parameters,
+            enable_cross_partition_query=True
+        ))
+
     def name_exists(self, first_name, last_name):
         """Check if name combination exists in database"""
-        # Use a count query for efficiency
+        # TOP 1 stops at the first match instead of counting every one
         query = """
-        SELECT VALUE COUNT(1) FROM c 
+        SELECT TOP 1 VALUE 1 FROM c 
         WHERE c.legalFirstName = @first_name 
         AND c.legalLastName = @last_name
         """
@@ -107,47 +195,56 @@ class CosmosDBClient:
             {"name": "@last_name", "value": last_name}
         ]
         
-        result = list(self.container.query_items(
+        results = self.container.query_items(
             query=query,
             parameters=parameters,
-            enable_cross_partition_query=True
-        ))
-        
-        return result[0] > 0 if result else False
+            enable_cross_partition_query=True,
+            max_item_count=1
+        )
+        return next(iter(results), None) is not None
 
     def batch_insert_embeddings(self, embeddings_dict):
-        """Insert multiple student embeddings"""
+        """Insert multiple student embeddings, overlapping the per-document round trips"""
+        if not embeddings_dict:
+            return []
+        
+        workers = min(BATCH_INSERT_WORKERS, len(embeddings_dict))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                pen: executor.submit(self.insert_student_embedding, data["student_data"], data["embedding"])
+                for pen, data in embeddings_dict.items()
+            }
+        
+        # Failures are collected from the futures and reported once per batch
         results = []
-        for pen, data in embeddings_dict.items():
-            try:
-                result = self.insert_student_embedding(
-                    data["student_data"], 
-                    data["embedding"]
-                )
-                results.append(result)
-                print(f"Successfully inserted student {pen}")
-            except Exception as e:
-                print(f"Failed to insert student {pen}: {str(e)}")
+        failures = {}
+        for pen, future in futures.items():
+            error = future.exception()
+            if error is None:
+                results.append(future.result())
+            else:
+                failures[pen] = error
+        
+        if failures:
+            print(f"Failed to insert {len(failures)} of {len(futures)} students:")
+            for pen, error in failures.items():
+                print(f"  {pen}: {error}")
         return results
 
     def delete_all_students(self):
-        """Delete all students from the database"""
-        query = "SELECT c.id, c.pen FROM c"
-        all_students = list(self.container.query_items(
-            query=query,
+        """Delete all students from the database by recreating the container"""
+        count_query = "SELECT VALUE COUNT(1) FROM c"
+        result = list(self.container.query_items(
+            query=count_query,
             enable_cross_partition_query=True
         ))
+        deleted_count = result[0] if result else 0
         
-        deleted_count = 0
-        for student in all_students:
-            try:
-                self.container.delete_item(
-                    item=student['id'], 
-                    partition_key=student['pen']
-                )
-                deleted_count += 1
-            except Exception as e:
-                print(f"Failed to delete student {student.get('pen')}: {str(e)}")
+        # Dropping the container is one control-plane call instead of a DELETE (and its RU) per student
+        self.database.delete_container(self.container_name)
+        with _setup_lock:
+            self._setup_database()
+            _setup_cache[self._setup_key()] = (self.database, self.container)
         
         return deleted_count
     
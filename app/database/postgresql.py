@@ -1,12 +1,42 @@
 import asyncio
 import asyncpg
 import ssl
-from typing import List, Dict, Any
+from pgvector.asyncpg import register_vector
+from typing import List, Dict, Any, Optional
+from uuid import UUID
 from config.settings import settings
 
+UPSERT_EMBEDDING_SQL = """
+    INSERT INTO "api_pen_match_v2".student_embeddings 
+    (student_id, embedding, dob, postal_code, mincode, sex_code, status_code, create_user, update_user)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) 
+    ON CONFLICT (student_id) DO UPDATE SET
+    embedding = EXCLUDED.embedding,
+    dob = EXCLUDED.dob,
+    postal_code = EXCLUDED.postal_code,
+    mincode = EXCLUDED.mincode,
+    sex_code = EXCLUDED.sex_code,
+    update_user = EXCLUDED.update_user, 
+    update_date = now()
+"""
+
+# Sorts before every other uuid, so it starts keyset pagination from the beginning
+NIL_UUID = UUID(int=0)
+
+async def _init_connection(conn):
+    """Per-connection setup run by the pool for every new connection"""
+    # Binary codec for vector/halfvec: embeddings are sent as raw float32 instead of text
+    await register_vector(conn)
+
 class PostgreSQLManager:
-    def __init__(self, max_connections=20):
+    def __init__(self, max_connections=20, application_name='embedding_import', min_connections=5,
+                 max_inactive_connection_lifetime=300, max_queries=50_000, statement_cache_size=256):
         self.max_connections = max_connections
+        self.min_connections = min_connections
+        self.application_name = application_name
+        self.max_inactive_connection_lifetime = max_inactive_connection_lifetime
+        self.max_queries = max_queries
+        self.statement_cache_size = statement_cache_size
         self.connection_pool = None
         
     async def create_pool(self):
@@ -19,11 +49,16 @@ class PostgreSQLManager:
                 password=settings.postgres_password,
                 database=settings.postgres_db,
                 ssl=ssl_context,
-                min_size=5,
+                min_size=min(self.min_connections, self.max_connections),
                 max_size=self.max_connections,
+                max_inactive_connection_lifetime=self.max_inactive_connection_lifetime,
+                max_queries=self.max_queries,
+                statement_cache_size=self.statement_cache_size,
                 command_timeout=120,
+                init=_init_connection,
                 server_settings={
-                    'application_name': 'embedding_import',
+                    'application_name': self.application_name,
+                    'search_path': 'api_pen_match_v2, public',
                     'tcp_keepalives_idle': '600',
                     'tcp_keepalives_interval': '30',
                     'tcp_keepalives_count': '3',
@@ -33,49 +68,47 @@ class PostgreSQLManager:
     async def get_connection(self):
         if not self.connection_pool:
             ssl_context = ssl.create_default_context()
-            return await asyncpg.connect(
+            conn = await asyncpg.connect(
                 host=settings.postgres_host,
                 port=settings.postgres_port,
                 user=settings.postgres_user,
                 password=settings.postgres_password,
                 database=settings.postgres_db,
-                ssl=ssl_context
+                ssl=ssl_context,
+                statement_cache_size=self.statement_cache_size,
+                server_settings={
+                    'application_name': self.application_name,
+                    'search_path': 'api_pen_match_v2, public',
+                }
             )
+            await _init_connection(conn)
+            return conn
         return self.connection_pool.acquire()
     
-    async def fetch_students_batch(self, offset: int, batch_size: int) -> List[Dict[str, Any]]:
+    async def fetch_students_batch(self, after_student_id: Optional[UUID], batch_size: int) -> List[asyncpg.Record]:
+        """Next page of students after after_student_id (None for the first page), in student_id order"""
+        # Columns are aliased to the student dict keys, so Records are used as-is (record["pen"], record.get(...)).
+        # Missing values come back as None, which every consumer already treats like the 'NULL' placeholder
         query = """
             SELECT student_id, 
-                   COALESCE(pen, 'NULL') as pen,
-                   COALESCE(legal_first_name, 'NULL') as legal_first_name,
-                   COALESCE(legal_last_name, 'NULL') as legal_last_name,
-                   COALESCE(legal_middle_names, 'NULL') as legal_middle_names,
-                   COALESCE(dob::text, 'NULL') as dob,
-                   COALESCE(sex_code, 'NULL') as sex_code,
-                   COALESCE(postal_code, 'NULL') as postal_code,
-                   COALESCE(mincode, 'NULL') as mincode,
-                   COALESCE(local_id, 'NULL') as local_id,
-                   COALESCE(LPAD(local_id::text, 8, '0'), 'NULL') as local_id_padded
+                   pen,
+                   legal_first_name as "legalFirstName",
+                   legal_last_name as "legalLastName",
+                   legal_middle_names as "legalMiddleNames",
+                   dob::text as dob,
+                   sex_code as "sexCode",
+                   postal_code as "postalCode",
+                   mincode,
+                   local_id as "localID"
             FROM "api_pen_match_v2".student 
+            WHERE student_id > $1
             ORDER BY student_id ASC
-            LIMIT $1 OFFSET $2
+            LIMIT $2
         """
         
+        # Keyset pagination: an index range scan from the last key instead of re-reading OFFSET rows
         async with self.connection_pool.acquire() as conn:
-            rows = await conn.fetch(query, batch_size, offset)
-        
-        return [{
-            "student_id": row[0],
-            "pen": row[1],
-            "legalFirstName": row[2],
-            "legalLastName": row[3],
-            "legalMiddleNames": row[4],
-            "dob": row[5],
-            "sexCode": row[6],
-            "postalCode": row[7],
-            "mincode": row[8],
-            "localID": row[9]
-        } for row in rows]
+            return await conn.fetch(query, after_student_id or NIL_UUID, batch_size)
     
     async def batch_upsert_embeddings(self, results: List[Dict[str, Any]]) -> int:
         successful_results = [r for r in results if r.get('success')]
@@ -84,20 +117,21 @@ class PostgreSQLManager:
         
         async with self.connection_pool.acquire() as conn:
             async with conn.transaction():
-                # Create temp table and copy data
+                # Staging table lives for the connection's session and is emptied at each commit,
+                # so after the first batch on a connection this is a catalog lookup, not DDL
                 await conn.execute("""
-                    CREATE TEMP TABLE temp_embeddings (
-                        student_id UUID, embedding TEXT, status_code VARCHAR(10), 
+                    CREATE TEMP TABLE IF NOT EXISTS temp_embeddings (
+                        student_id UUID, embedding vector, status_code VARCHAR(10), 
                         create_user VARCHAR(255), update_user VARCHAR(255)
-                    )
+                    ) ON COMMIT DELETE ROWS
                 """)
                 
-                copy_data = ''.join([
-                    f"{r['student_id']}\t[{','.join(str(x) for x in r['embedding'])}]\tA\tsystem\tsystem\n"
-                    for r in successful_results
-                ])
-                
-                await conn.copy_to_table('temp_embeddings', source=copy_data, format='text', delimiter='\t')
+                # Binary COPY: the pgvector codec encodes each embedding as raw floats, no text formatting
+                await conn.copy_records_to_table(
+                    'temp_embeddings',
+                    records=[(r['student_id'], r['embedding'], 'A', 'system', 'system') for r in successful_results],
+                    columns=['student_id', 'embedding', 'status_code', 'create_user', 'update_user']
+                )
                 
                 # Upsert from temp table
                 await conn.execute("""
@@ -1,8 +1,15 @@
 import requests
 import json
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from openai import OpenAI, AzureOpenAI
 from config.settings import settings
 
+# Refresh the access token this many seconds before it actually expires
+TOKEN_EXPIRY_MARGIN_SECONDS = 30
+
 class StudentAPI:
     def __init__(self):
         # Configure OpenAI client
@@ -14,21 +21,42 @@ class StudentAPI:
             )
         else:
             self.openai_client = OpenAI(api_key=settings.openai_api_key)
+        
+        # Keep-alive session so paging doesn't pay a TLS handshake per request
+        self.session = requests.Session()
+        retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=None)
+        self.session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retries))
+        
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
 
     def get_access_token(self):
-        """Get access token for student API"""
+        """Get access token for student API, reusing it until shortly before it expires"""
+        with self._token_lock:
+            if self._token and time.monotonic() < self._token_expires_at - TOKEN_EXPIRY_MARGIN_SECONDS:
+                return self._token
+            
+            self._token, expires_in = self._request_access_token()
+            self._token_expires_at = time.monotonic() + expires_in
+            return self._token
+
+    def _request_access_token(self):
         token_url = f"{settings.tenant_url}/protocol/openid-connect/token"
         data = {
             "grant_type": "client_credentials",
             "client_id": settings.client_id,
             "client_secret": settings.client_secret
         }
-        response = requests.post(token_url, data=data)
+        response = self.session.post(token_url, data=data)
         response.raise_for_status()
-        token = response.json().get("access_token")
+        payload = response.json()
+        token = payload.get("access_token")
         if not token:
             raise ValueError("No access_token returned")
-        return token
+        # Without expires_in the token is treated as already expired and never reused
+        return token, payload.get("expires_in", 0)
 
     def get_student_page(self, page=1, size=20, sort=None, filter_query=None):
         """Fetch paginated student data"""
@@ -41,7 +69,7 @@ class StudentAPI:
             params["filter"] = filter_query
 
         endpoint = f"{settings.api_base_url}/api/v1/student/paginated"
-        response = requests.get(endpoint, headers=headers, params=params)
+        response = self.session.get(endpoint, headers=headers, params=params)
         response.raise_for_status()
         
         try:
@@ -1,8 +1,41 @@
 import csv
-import json
+import os
 import random
+from collections import Counter
 import string
-from typing import List, Dict, Any
+import orjson
+import numpy as np
+from dataclasses import dataclass, asdict
+from multiprocessing import Pool
+from typing import List, Dict, Any, Iterator, Optional
+
+# Replacement tables per current character, so typo helpers pick a replacement with one randrange draw
+_LOWER = tuple(string.ascii_lowercase)
+_ALNUM = tuple(string.ascii_uppercase + string.digits)
+_LOWER_REPL = {c: tuple(r for r in _LOWER if r != c) for c in _LOWER}
+_ALNUM_REPL = {c: tuple(r for r in _ALNUM if r != c) for c in _ALNUM}
+
+# Seed for synthesized DOBs so regenerated datasets stay comparable between runs
+DOB_SEED = 42
+
+# Below this many students, worker start-up costs more than generating the queries serially
+PARALLEL_MIN_STUDENTS = 10000
+QUERY_CHUNKSIZE = 256
+
+# Student list handed to each worker once by the pool initializer instead of pickled per task
+_worker_students = None
+
+@dataclass(slots=True)
+class Student:
+    """Parsed CSV student record; field names match the query JSON keys"""
+    pen_number: str
+    legalFirstName: str
+    legalMiddleNames: str
+    legalLastName: str
+    dob: str
+    sexCode: str
+    postalCode: str
+    mincode: str
 
 def change_last_letter(text: str) -> str:
     """Change the last letter of a string to a random letter"""
@@ -11,12 +44,8 @@ def change_last_letter(text: str) -> str:
     
     # Get all letters except the current last letter
     current_last = text[-1].lower()
-    available_letters = [c for c in string.ascii_lowercase if c != current_last]
-    
-    if not available_letters:
-        return text
-    
-    new_last_letter = random.choice(available_letters)
+    available_letters = _LOWER_REPL.get(current_last, _LOWER)
+    new_last_letter = available_letters[random.randrange(len(available_letters))]
     
     # Preserve case
     if text[-1].isupper():
@@ -31,26 +60,26 @@ def change_last_two_digits(text: str) -> str:
     
     # For numeric strings, change to different digits
     if text[-2:].isdigit():
-        current_digits = text[-2:]
-        while True:
-            new_digits = f"{random.randint(0, 99):02d}"
-            if new_digits != current_digits:
-                return text[:-2] + new_digits
+        # Draw from the 99 other values and skip over the current one, so one draw always differs
+        current = int(text[-2:])
+        new_value = random.randrange(99)
+        if new_value >= current:
+            new_value += 1
+        return text[:-2] + f"{new_value:02d}"
     else:
         # For alphanumeric, change last two characters
-        available_chars = string.ascii_uppercase + string.digits
         new_chars = ""
         for i in range(2):
             pos = len(text) - 2 + i
             if pos < len(text):
                 current_char = text[pos]
-                available = [c for c in available_chars if c != current_char]
-                new_chars += random.choice(available) if available else current_char
+                available = _ALNUM_REPL.get(current_char, _ALNUM)
+                new_chars += available[random.randrange(len(available))]
         return text[:-2] + new_chars
     
     return text
 
-def parse_student_record(row: List[str]) -> Dict[str, str]:
+def parse_student_record(row: List[str]) -> Optional[Student]:
     """
     Parse a CSV row into student record using the correct column indices
     CSV Header: STUDENT_ID,PEN,LEGAL_FIRST_NAME,LEGAL_MIDDLE_NAMES,LEGAL_LAST_NAME,DOB,SEX_CODE,GENDER_CODE,USUAL_FIRST_NAME,USUAL_MIDDLE_NAMES,USUAL_LAST_NAME,EMAIL,DECEASED_DATE,CREATE_USER,CREATE_DATE,UPDATE_USER,UPDATE_DATE,POSTAL_CODE,LOCAL_ID,GRADE_CODE,MINCODE,EMAIL_VERIFIED,MEMO,GRADE_YEAR,DEMOG_CODE,STATUS_CODE,TRUE_STUDENT_ID,DOCUMENT_TYPE_CODE,DATE_OF_CONFIRMATION
@@ -68,13 +97,9 @@ def parse_student_record(row: List[str]) -> Dict[str, str]:
     postal_code = row[17].strip() if len(row) > 17 else ""  # POSTAL_CODE
     mincode = row[20].strip() if len(row) > 20 else ""   # MINCODE
     
-    # Handle DOB - if it's empty or invalid, generate a realistic one
+    # Handle DOB - empty or invalid values are left blank and filled in by fill_missing_dobs
     if not dob or dob in ['', 'NULL', 'null']:
-        # Generate a realistic DOB (format: YYYY-MM-DD)
-        year = random.randint(1990, 2010)
-        month = random.randint(1, 12)
-        day = random.randint(1, 28)  # Use 28 to avoid month-specific day issues
-        dob = f"{year}-{month:02d}-{day:02d}"
+        dob = ""
     else:
         # Try to parse and reformat the DOB if it exists
         try:
@@ -89,122 +114,120 @@ def parse_student_record(row: List[str]) -> Dict[str, str]:
             elif len(dob) == 10 and dob.count('-') == 2:
                 pass  # Already in correct format
             else:
-                # If format is unrecognizable, generate a new one
-                year = random.randint(1990, 2010)
-                month = random.randint(1, 12)
-                day = random.randint(1, 28)
-                dob = f"{year}-{month:02d}-{day:02d}"
+                # If format is unrecognizable, leave it for fill_missing_dobs
+                dob = ""
         except:
-            # If any parsing fails, generate a new DOB
-            year = random.randint(1990, 2010)
-            month = random.randint(1, 12)
-            day = random.randint(1, 28)
-            dob = f"{year}-{month:02d}-{day:02d}"
+            # If any parsing fails, leave it for fill_missing_dobs
+            dob = ""
     
     # Skip records without essential data
     if not pen_number or not first_name or not last_name:
         return None
     
-    return {
-        "pen_number": pen_number,
-        "legalFirstName": first_name,
-        "legalMiddleNames": middle_name,
-        "legalLastName": last_name,
-        "dob": dob,
-        "sexCode": sex_code,
-        "postalCode": postal_code,
-        "mincode": mincode
-    }
+    return Student(
+        pen_number=pen_number,
+        legalFirstName=first_name,
+        legalMiddleNames=middle_name,
+        legalLastName=last_name,
+        dob=dob,
+        sexCode=sex_code,
+        postalCode=postal_code,
+        mincode=mincode
+    )
 
-def generate_typo_queries(student: Dict[str, str]) -> List[Dict[str, Any]]:
+def generate_typo_queries(student: Student) -> List[Dict[str, Any]]:
     """Generate 6 typo queries for a student with CONFIRM review_label (removed sex_code_typo)"""
     queries = []
+    append = queries.append
+    
+    # Read each field once; they are reused for the query, original_value and the checks below
+    pen = student.pen_number
+    first_name = student.legalFirstName
+    last_name = student.legalLastName
+    middle_name = student.legalMiddleNames
+    dob = student.dob
+    postal_code = student.postalCode
+    mincode = student.mincode
     
     # Original record for reference
     original = {
-        "legalFirstName": student["legalFirstName"],
-        "legalLastName": student["legalLastName"], 
-        "legalMiddleNames": student["legalMiddleNames"],
-        "dob": student["dob"],
-        "sexCode": student["sexCode"],
-        "postalCode": student["postalCode"],
-        "mincode": student["mincode"]
+        "legalFirstName": first_name,
+        "legalLastName": last_name, 
+        "legalMiddleNames": middle_name,
+        "dob": dob,
+        "sexCode": student.sexCode,
+        "postalCode": postal_code,
+        "mincode": mincode
     }
     
     # 1. First name: Change the last letter
-    if student["legalFirstName"]:
-        query1 = original.copy()
-        query1["legalFirstName"] = change_last_letter(student["legalFirstName"])
-        queries.append({
+    if first_name:
+        query1 = {**original, "legalFirstName": change_last_letter(first_name)}
+        append({
             "query_type": "first_name_typo",
             "review_label": "CONFIRM",
-            "ground_truth_pen": student["pen_number"],
+            "ground_truth_pen": pen,
             "query": query1,
-            "original_value": student["legalFirstName"],
+            "original_value": first_name,
             "typo_value": query1["legalFirstName"]
         })
     
     # 2. Last name: Change the last letter  
-    if student["legalLastName"]:
-        query2 = original.copy()
-        query2["legalLastName"] = change_last_letter(student["legalLastName"])
-        queries.append({
+    if last_name:
+        query2 = {**original, "legalLastName": change_last_letter(last_name)}
+        append({
             "query_type": "last_name_typo",
             "review_label": "CONFIRM",
-            "ground_truth_pen": student["pen_number"],
+            "ground_truth_pen": pen,
             "query": query2,
-            "original_value": student["legalLastName"],
+            "original_value": last_name,
             "typo_value": query2["legalLastName"]
         })
     
     # 3. Middle name: Change the last letter
-    if student["legalMiddleNames"]:
-        query3 = original.copy()
-        query3["legalMiddleNames"] = change_last_letter(student["legalMiddleNames"])
-        queries.append({
+    if middle_name:
+        query3 = {**original, "legalMiddleNames": change_last_letter(middle_name)}
+        append({
             "query_type": "middle_name_typo",
             "review_label": "CONFIRM",
-            "ground_truth_pen": student["pen_number"],
+            "ground_truth_pen": pen,
             "query": query3,
-            "original_value": student["legalMiddleNames"],
+            "original_value": middle_name,
             "typo_value": query3["legalMiddleNames"]
         })
     
     # 4. DOB: Change the last two digits (day part)
-    query4 = original.copy()
-    query4["dob"] = change_last_two_digits(student["dob"])
-    queries.append({
+    query4 = {**original, "dob": change_last_two_digits(dob)}
+    append({
         "query_type": "dob_typo",
         "review_label": "CONFIRM",
-        "ground_truth_pen": student["pen_number"],
+        "ground_truth_pen": pen,
         "query": query4,
-        "original_value": student["dob"],
+        "original_value": dob,
         "typo_value": query4["dob"]
     })
     
     # 5. Postal code: Change the last two characters
-    if student["postalCode"]:
-        query5 = original.copy()
-        query5["postalCode"] = change_last_two_digits(student["postalCode"])
-        queries.append({
+    if postal_code:
+        query5 = {**original, "postalCode": change_last_two_digits(postal_code)}
+        append({
             "query_type": "postal_code_typo",
             "review_label": "CONFIRM",
-            "ground_truth_pen": student["pen_number"],
+            "ground_truth_pen": pen,
             "query": query5,
-            "original_value": student["postalCode"],
+            "original_value": postal_code,
             "typo_value": query5["postalCode"]
         })
     
     # 6. Mincode: Change the last two digits
-    if student["mincode"]:
-        query6 = original.copy()
-        query6["mincode"] = change_last_two_digits(student["mincode"])
-        queries.append({
+    if mincode:
+        query6 = {**original, "mincode": change_last_two_digits(mincode)}
+        append({
             "query_type": "mincode_typo",
             "review_label": "CONFIRM",
-            "ground_truth_pen": student["pen_number"],
+            "ground_truth_pen": pen,
             "query": query6,
-            "original_value": student["mincode"],
+            "original_value": mincode,
             "typo_value": query6["mincode"]
         })
     
@@ -212,85 +235,153 @@ def generate_typo_queries(student: Dict[str, str]) -> List[Dict[str, Any]]:
     
     return queries
 
-def generate_conflict_queries(target_student: Dict[str, str], all_students: List[Dict[str, str]]) -> List[Dict[str, Any]]:
-    """Generate 3 conflict queries for a student with REVIEW review_label"""
+def pick_conflict_students(target_index: int, all_students: List[Student], count: int = 3) -> List[Student]:
+    """
+    Pick `count` students with distinct PENs that differ from the target's, by rejection
+    sampling single indices instead of building a filtered copy of all_students for every target
+    """
+    picked = []
+    picked_pens = {all_students[target_index].pen_number}
+    randrange = random.randrange
+    size = len(all_students)
+    
+    # Duplicate PENs are rare, so each pick almost always succeeds on its first draw
+    for _ in range(count * 10):
+        student = all_students[randrange(size)]
+        if student.pen_number not in picked_pens:
+            picked_pens.add(student.pen_number)
+            picked.append(student)
+            if len(picked) == count:
+                return picked
+    
+    # Tiny or PEN-heavy datasets can exhaust the draws; a linear scan settles those
+    for student in all_students:
+        if len(picked) == count:
+            break
+        if student.pen_number not in picked_pens:
+            picked_pens.add(student.pen_number)
+            picked.append(student)
+    
+    return picked
+
+def generate_conflict_queries(target_index: int, all_students: List[Student]) -> List[Dict[str, Any]]:
+    """Generate 3 conflict queries for the student at target_index with REVIEW review_label"""
     queries = []
+    target_student = all_students[target_index]
     
     # Get other students for conflict data
-    other_students = [s for s in all_students if s["pen_number"] != target_student["pen_number"]]
+    conflict_students = pick_conflict_students(target_index, all_students)
     
-    if len(other_students) < 3:
-        print(f"Warning: Not enough other students for conflicts for PEN {target_student['pen_number']}")
+    if len(conflict_students) < 3:
+        print(f"Warning: Not enough other students for conflicts for PEN {target_student.pen_number}")
         return queries
     
+    conflict_student_1, conflict_student_2, conflict_student_3 = conflict_students
+    
     # Base query with correct name information
     base_query = {
-        "legalFirstName": target_student["legalFirstName"],
-        "legalLastName": target_student["legalLastName"], 
-        "legalMiddleNames": target_student["legalMiddleNames"],
-        "dob": target_student["dob"],
-        "sexCode": target_student["sexCode"],
-        "postalCode": target_student["postalCode"],
-        "mincode": target_student["mincode"]
+        "legalFirstName": target_student.legalFirstName,
+        "legalLastName": target_student.legalLastName, 
+        "legalMiddleNames": target_student.legalMiddleNames,
+        "dob": target_student.dob,
+        "sexCode": target_student.sexCode,
+        "postalCode": target_student.postalCode,
+        "mincode": target_student.mincode
     }
     
     # 8. Wrong DOB (use another student's DOB)
-    conflict_student_1 = random.choice(other_students)
-    query8 = base_query.copy()
-    query8["dob"] = conflict_student_1["dob"]
+    query8 = {**base_query, "dob": conflict_student_1.dob}
     queries.append({
         "query_type": "wrong_dob",
         "review_label": "REVIEW",
-        "ground_truth_pen": target_student["pen_number"],
-        "conflict_source_pen": conflict_student_1["pen_number"],
+        "ground_truth_pen": target_student.pen_number,
+        "conflict_source_pen": conflict_student_1.pen_number,
         "query": query8,
-        "original_value": target_student["dob"],
-        "conflict_value": conflict_student_1["dob"]
+        "original_value": target_student.dob,
+        "conflict_value": conflict_student_1.dob
     })
     
     # 9. Wrong postal code (use another student's postal code)
-    conflict_student_2 = random.choice([s for s in other_students if s["pen_number"] != conflict_student_1["pen_number"]])
-    query9 = base_query.copy()
-    query9["postalCode"] = conflict_student_2["postalCode"]
+    query9 = {**base_query, "postalCode": conflict_student_2.postalCode}
     queries.append({
         "query_type": "wrong_postal_code",
         "review_label": "REVIEW",
-        "ground_truth_pen": target_student["pen_number"],
-        "conflict_source_pen": conflict_student_2["pen_number"],
+        "ground_truth_pen": target_student.pen_number,
+        "conflict_source_pen": conflict_student_2.pen_number,
         "query": query9,
-        "original_value": target_student["postalCode"],
-        "conflict_value": conflict_student_2["postalCode"]
+        "original_value": target_student.postalCode,
+        "conflict_value": conflict_student_2.postalCode
     })
     
     # 10. Wrong mincode (use another student's mincode)
-    conflict_student_3 = random.choice([s for s in other_students 
-                                      if s["pen_number"] not in [conflict_student_1["pen_number"], 
-                                                                conflict_student_2["pen_number"]]])
-    query10 = base_query.copy()
-    query10["mincode"] = conflict_student_3["mincode"]
+    query10 = {**base_query, "mincode": conflict_student_3.mincode}
     queries.append({
         "query_type": "wrong_mincode",
         "review_label": "REVIEW",
-        "ground_truth_pen": target_student["pen_number"],
-        "conflict_source_pen": conflict_student_3["pen_number"],
+        "ground_truth_pen": target_student.pen_number,
+        "conflict_source_pen": conflict_student_3.pen_number,
         "query": query10,
-        "original_value": target_student["mincode"],
-        "conflict_value": conflict_student_3["mincode"]
+        "original_value": target_student.mincode,
+        "conflict_value": conflict_student_3.mincode
     })
     
     return queries
 
-def generate_review_dataset():
-    """Generate comprehensive review queries from the CSV dataset"""
-    input_file = "app/evaluation/Test_dataset_100.csv"
-    output_file = "app/evaluation/test_queries_review.json"
+def fill_missing_dobs(students: List[Student], seed: int = DOB_SEED) -> None:
+    """Give every student without a usable DOB a realistic one, drawn in a single numpy pass"""
+    missing = [student for student in students if not student.dob]
+    if not missing:
+        return
+    
+    rng = np.random.default_rng(seed)
+    count = len(missing)
+    years = rng.integers(1990, 2011, count)
+    months = rng.integers(1, 13, count)
+    days = rng.integers(1, 29, count)  # Use 28 to avoid month-specific day issues
     
+    for student, year, month, day in zip(missing, years.tolist(), months.tolist(), days.tolist()):
+        student.dob = f"{year}-{month:02d}-{day:02d}"
+
+def _generate_student_queries(index: int, all_students: List[Student]) -> Optional[List[Dict[str, Any]]]:
+    """All typo and conflict queries for one student, or None if generation failed"""
+    student = all_students[index]
+    try:
+        # Typo queries (6 queries with CONFIRM review_label, removed sex_code_typo)
+        # followed by conflict queries (3 queries with REVIEW review_label)
+        return generate_typo_queries(student) + generate_conflict_queries(index, all_students)
+    except Exception as e:
+        print(f"Error generating queries for PEN {student.pen_number}: {e}")
+        return None
+
+def _init_query_worker(all_students: List[Student]) -> None:
+    global _worker_students
+    _worker_students = all_students
+    # Forked workers inherit the parent's random state; reseed so they don't draw identical typos
+    random.seed(os.getpid())
+
+def _generate_worker_queries(index: int) -> Optional[List[Dict[str, Any]]]:
+    return _generate_student_queries(index, _worker_students)
+
+def iter_student_queries(all_students: List[Student]) -> Iterator[Optional[List[Dict[str, Any]]]]:
+    """Yield each student's queries in student order, using worker processes for large datasets"""
+    indices = range(len(all_students))
+    if len(all_students) < PARALLEL_MIN_STUDENTS or (os.cpu_count() or 1) < 2:
+        for index in indices:
+            yield _generate_student_queries(index, all_students)
+        return
+    
+    # imap (not imap_unordered) keeps queries grouped by student in CSV order, which the
+    # evaluation loaders rely on when selecting the first N students
+    with Pool(initializer=_init_query_worker, initargs=(all_students,)) as pool:
+        yield from pool.imap(_generate_worker_queries, indices, chunksize=QUERY_CHUNKSIZE)
+
+def load_students(input_file: str) -> List[Student]:
+    """Read the student CSV and parse every usable row (None if the file can't be read)"""
     all_students = []
-    all_queries = []
     
     try:
-        # Use proper CSV reader to handle headers and quoted fields
-        with open(input_file, 'r', encoding='utf-8') as file:
+        # newline='' lets the csv module handle quoted fields with embedded line breaks
+        with open(input_file, 'r', encoding='utf-8', newline='') as file:
             csv_reader = csv.reader(file)
             
             # Skip header row
@@ -310,7 +401,7 @@ def generate_review_dataset():
                 try:
                     # Parse student record
                     student = parse_student_record(row)
-                    if student and student["pen_number"]:
+                    if student and student.pen_number:
                         all_students.append(student)
                         
                 except Exception as e:
@@ -319,82 +410,93 @@ def generate_review_dataset():
     
     except FileNotFoundError:
         print(f"File {input_file} not found!")
-        return
+        return None
     except Exception as e:
         print(f"Error reading file: {e}")
+        return None
+    
+    fill_missing_dobs(all_students)
+    return all_students
+
+def generate_review_dataset():
+    """Generate comprehensive review queries from the CSV dataset"""
+    input_file = "app/evaluation/Test_dataset_100.csv"
+    # One query per line so consumers can stream it; summary counts go in a small sidecar file
+    output_file = "app/evaluation/test_queries_review.jsonl"
+    metadata_file = "app/evaluation/test_queries_review.meta.json"
+    
+    all_students = load_students(input_file)
+    if all_students is None:
         return
     
     print(f"Collected {len(all_students)} students")
     
-    # Second pass: generate all queries for each student
     processed_count = 0
-    for student in all_students:
-        try:
-            # Generate typo queries (6 queries with CONFIRM review_label, removed sex_code_typo)
-            typo_queries = generate_typo_queries(student)
-            all_queries.extend(typo_queries)
-            
-            # Generate conflict queries (3 queries with REVIEW review_label)
-            conflict_queries = generate_conflict_queries(student, all_students)
-            all_queries.extend(conflict_queries)
-            
-            processed_count += 1
-            
-            if processed_count % 10 == 0:
-                print(f"Processed {processed_count} students...")
+    total_queries = 0
+    
+    # Count queries by type and review_label as they are written
+    query_type_counts = Counter()
+    review_label_counts = Counter()
+    
+    # Second pass: generate each student's queries and stream them straight to the JSONL file,
+    # so the full query list is never held in memory
+    try:
+        with open(output_file, 'wb') as f:
+            write = f.write
+            for student_queries in iter_student_queries(all_students):
+                if student_queries is None:
+                    continue
+                
+                for query in student_queries:
+                    # orjson writes UTF-8 directly (same output as ensure_ascii=False) and serializes in C
+                    write(orjson.dumps(query, option=orjson.OPT_APPEND_NEWLINE))
+                    query_type_counts[query["query_type"]] += 1
+                    review_label_counts[query["review_label"]] += 1
                 
-        except Exception as e:
-            print(f"Error generating queries for PEN {student['pen_number']}: {e}")
-            continue
+                total_queries += len(student_queries)
+                processed_count += 1
+                
+                if processed_count % 10 == 0:
+                    print(f"Processed {processed_count} students...")
+    except Exception as e:
+        print(f"Error saving output file: {e}")
+        return
     
-    # Save to JSON file
+    # Save metadata sidecar
     try:
-        # Count queries by type and review_label
-        query_type_counts = {}
-        review_label_counts = {"CONFIRM": 0, "REVIEW": 0}
-        
-        for query in all_queries:
-            qtype = query["query_type"]
-            review_label = query["review_label"]
-            query_type_counts[qtype] = query_type_counts.get(qtype, 0) + 1
-            review_label_counts[review_label] += 1
-        
-        output_data = {
-            "metadata": {
-                "description": "Comprehensive review test queries for PEN matching evaluation",
-                "purpose": "Test system ability to find correct PEN with both typos (CONFIRM) and conflicts (REVIEW)",
-                "total_students_processed": processed_count,
-                "total_queries_generated": len(all_queries),
-                "queries_per_student": 9,  # Updated: 6 typo + 3 conflict = 9 total
-                "query_categories": {
-                    "typo_queries": {
-                        "review_label": "CONFIRM",
-                        "count": review_label_counts["CONFIRM"],
-                        "types": ["first_name_typo", "last_name_typo", "middle_name_typo", 
-                                "dob_typo", "postal_code_typo", "mincode_typo"]  # Removed sex_code_typo
-                    },
-                    "conflict_queries": {
-                        "review_label": "REVIEW", 
-                        "count": review_label_counts["REVIEW"],
-                        "types": ["wrong_dob", "wrong_postal_code", "wrong_mincode"]
-                    }
+        metadata = {
+            "description": "Comprehensive review test queries for PEN matching evaluation",
+            "purpose": "Test system ability to find correct PEN with both typos (CONFIRM) and conflicts (REVIEW)",
+            "total_students_processed": processed_count,
+            "total_queries_generated": total_queries,
+            "queries_per_student": 9,  # Updated: 6 typo + 3 conflict = 9 total
+            "query_categories": {
+                "typo_queries": {
+                    "review_label": "CONFIRM",
+                    "count": review_label_counts["CONFIRM"],
+                    "types": ["first_name_typo", "last_name_typo", "middle_name_typo", 
+                            "dob_typo", "postal_code_typo", "mincode_typo"]  # Removed sex_code_typo
                 },
-                "query_type_breakdown": query_type_counts
+                "conflict_queries": {
+                    "review_label": "REVIEW", 
+                    "count": review_label_counts["REVIEW"],
+                    "types": ["wrong_dob", "wrong_postal_code", "wrong_mincode"]
+                }
             },
-            "queries": all_queries
+            "query_type_breakdown": query_type_counts
         }
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
+        with open(metadata_file, 'wb') as f:
+            f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
         
-        print(f"\nGenerated {len(all_queries)} total queries from {processed_count} students")
-        print(f"Output saved to {output_file}")
+        print(f"\nGenerated {total_queries} total queries from {processed_count} students")
+        print(f"Output saved to {output_file} (metadata in {metadata_file})")
         
         # Print detailed summary
         print(f"\nQuery breakdown:")
         print(f"  CONFIRM queries (typos): {review_label_counts['CONFIRM']}")
         print(f"  REVIEW queries (conflicts): {review_label_counts['REVIEW']}")
-        print(f"  Total: {len(all_queries)}")
+        print(f"  Total: {total_queries}")
         
         print(f"\nDetailed query type counts:")
         for qtype, count in sorted(query_type_counts.items()):
@@ -405,7 +507,7 @@ def generate_review_dataset():
         if all_students:
             print(f"\nSample student record:")
             sample = all_students[0]
-            for key, value in sample.items():
+            for key, value in asdict(sample).items():
                 print(f"  {key}: {value}")
         
     except Exception as e:
@@ -1,19 +1,33 @@
-import json
+import orjson
 import sys
 import os
 from typing import Dict, List, Any, Tuple
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Add the parent directory to the path to import modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from azure_search.azure_search_query import search_student_by_query
 
+# Searches are network-bound round-trips, so this many run concurrently
+MAX_SEARCH_WORKERS = 16
+
 def load_test_queries(file_path: str) -> Dict[str, Any]:
-    """Load test queries from JSON file"""
+    """Load test queries from a JSONL file plus its .meta.json sidecar"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            queries = [orjson.loads(line) for line in f if line.strip()]
+        
+        # Metadata is optional; it only feeds the summary in analyze_results
+        metadata = {}
+        metadata_path = os.path.splitext(file_path)[0] + ".meta.json"
+        if os.path.exists(metadata_path):
+            with open(metadata_path, 'rb') as f:
+                metadata = orjson.loads(f.read())
+        
+        return {"metadata": metadata, "queries": queries}
     except FileNotFoundError:
         print(f"Error: File {file_path} not found!")
         return None
@@ -67,14 +81,16 @@ def run_single_query(query_data: Dict[str, Any], ground_truth_pen: str, query_in
         top_20_results = results[:20]
         retrieved_pens = extract_pen_from_results(top_20_results)
         
-        # Calculate metrics
-        recall_20 = calculate_recall_at_k(ground_truth_pen, retrieved_pens, 20)
-        mrr = calculate_mrr(ground_truth_pen, retrieved_pens)
+        # Find rank of ground truth once and derive every metric from it; retrieved_pens is
+        # already cut to the top 20, so being found at all means recall@20 = 1
+        try:
+            rank = retrieved_pens.index(ground_truth_pen) + 1  # 1-indexed
+        except ValueError:
+            rank = None
         
-        # Find rank of ground truth
-        rank = None
-        if ground_truth_pen in retrieved_pens:
-            rank = retrieved_pens.index(ground_truth_pen) + 1
+        # Calculate metrics (same definitions as calculate_recall_at_k / calculate_mrr)
+        recall_20 = 1.0 if rank is not None else 0.0
+        mrr = 1.0 / rank if rank is not None else 0.0
         
         return {
             'success': True,
@@ -107,7 +123,7 @@ def run_single_query(query_data: Dict[str, Any], ground_truth_pen: str, query_in
             'found_in_top_20': False
         }
 
-def run_evaluation(test_file_path: str = "evaluation/test_queries_review.json", max_queries: int = None) -> Dict[str, Any]:
+def run_evaluation(test_file_path: str = "evaluation/test_queries_review.jsonl", max_queries: int = None) -> Dict[str, Any]:
     """Run evaluation on all test queries"""
     
     print("Loading test queries...")
@@ -122,14 +138,9 @@ def run_evaluation(test_file_path: str = "evaluation/test_queries_review.json",
     print(f"Loaded {len(queries)} test queries")
     print("Starting evaluation...")
     
-    results = []
-    total_queries = len(queries)
-    
-    # Progress tracking
+    # Validate first so skipped queries are still reported by their position in the file
+    valid_queries = []
     for i, query_info in enumerate(queries, 1):
-        if i % 10 == 0 or i == 1:
-            print(f"Processing query {i}/{total_queries} ({i/total_queries*100:.1f}%)")
-        
         query_data = query_info.get('query', {})
         ground_truth_pen = str(query_info.get('ground_truth_pen', ''))
         
@@ -137,8 +148,20 @@ def run_evaluation(test_file_path: str = "evaluation/test_queries_review.json",
             print(f"Warning: Skipping invalid query {i}")
             continue
         
-        result = run_single_query(query_data, ground_truth_pen, query_info)
-        results.append(result)
+        valid_queries.append((query_data, ground_truth_pen, query_info))
+    
+    total_queries = len(valid_queries)
+    
+    # Overlap the search round-trips; results are collected in query order once all are done
+    with ThreadPoolExecutor(max_workers=MAX_SEARCH_WORKERS) as executor:
+        futures = [executor.submit(run_single_query, *args) for args in valid_queries]
+        
+        # Progress tracking
+        for i, _ in enumerate(as_completed(futures), 1):
+            if i % 10 == 0 or i == 1:
+                print(f"Processing query {i}/{total_queries} ({i/total_queries*100:.1f}%)")
+        
+        results = [future.result() for future in futures]
     
     print(f"\nCompleted evaluation of {len(results)} queries")
     return analyze_results(results, test_data.get('metadata', {}))
@@ -221,14 +244,9 @@ def analyze_results(results: List[Dict[str, Any]], metadata: Dict[str, Any]) ->
         pstatus = result.get('pen_status', 'Unknown')
         pen_status_dist[pstatus] = pen_status_dist.get(pstatus, 0) + 1
     
-    # Rank distribution for found items
-    rank_distribution = {}
+    # Rank distribution for found items, keyed by int rank so the report can sort without parsing
     found_results = [r for r in successful_queries if r['found_in_top_20']]
-    for result in found_results:
-        rank = result['rank']
-        if rank:
-            rank_bin = f"Rank {rank}"
-            rank_distribution[rank_bin] = rank_distribution.get(rank_bin, 0) + 1
+    rank_distribution = Counter(r['rank'] for r in found_results if r['rank'])
     
     analysis = {
         'evaluation_summary': {
@@ -309,18 +327,18 @@ def print_evaluation_report(analysis: Dict[str, Any]):
     # Top rank positions for found items
     if analysis['rank_distribution']:
         print(f"\nRANK DISTRIBUTION (Found Items Only):")
-        sorted_ranks = sorted(analysis['rank_distribution'].items(), 
-                            key=lambda x: int(x[0].split()[1]))
+        sorted_ranks = sorted(analysis['rank_distribution'].items())
         for rank, count in sorted_ranks[:10]:  # Show top 10 ranks
-            print(f"  {rank}: {count}")
+            print(f"  Rank {rank}: {count}")
         if len(sorted_ranks) > 10:
             print(f"  ... and {len(sorted_ranks) - 10} more ranks")
 
 def save_results(analysis: Dict[str, Any], output_file: str = "evaluation_results.json"):
     """Save evaluation results to JSON file"""
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(analysis, f, indent=2, ensure_ascii=False, default=str)
+        # OPT_NON_STR_KEYS writes int keys (e.g. ranks) as strings, like json.dump did
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(analysis, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         print(f"\nResults saved to {output_file}")
     except Exception as e:
         print(f"Error saving results: {e}")
@@ -331,7 +349,7 @@ def main():
     print("-" * 40)
     
     # Configuration
-    test_file = "evaluation/test_queries_review.json"
+    test_file = "evaluation/test_queries_review.jsonl"
     max_queries = None  # Set to a number to limit queries for testing, None for all
     
     print(f"Test file: {test_file}")
@@ -1,4 +1,4 @@
-import json
+import orjson
 import sys
 import os
 from typing import Dict, List, Any, Tuple
@@ -10,30 +10,28 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from pen_agent.workflow import create_pen_match_workflow
 
 def load_test_queries_by_students(file_path: str, max_students: int = 10) -> List[Dict[str, Any]]:
-    """Load test queries for the first N students from JSON file"""
+    """Load test queries for the first N students from JSONL file"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            queries = data.get('queries', [])
-            
-        if not queries:
-            return []
-        
-        # Since queries are already in order, we can just iterate and track unique PENs
+        # Since queries are already in order, we can stream lines, track unique PENs
+        # and stop reading as soon as we pass the last requested student
         selected_queries = []
         seen_pens = set()
         students_processed = 0
         
-        for query in queries:
-            pen = query.get('ground_truth_pen', '')
-            if pen not in seen_pens:
-                seen_pens.add(pen)
-                students_processed += 1
-                
-            if students_processed <= max_students:
-                selected_queries.append(query)
-            else:
-                break
+        with open(file_path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                query = orjson.loads(line)
+                pen = query.get('ground_truth_pen', '')
+                if pen not in seen_pens:
+                    seen_pens.add(pen)
+                    students_processed += 1
+                    
+                if students_processed <= max_students:
+                    selected_queries.append(query)
+                else:
+                    break
         
         return selected_queries
         
@@ -45,12 +43,16 @@ def load_test_queries_by_students(file_path: str, max_students: int = 10) -> Lis
         return []
 
 def load_test_queries(file_path: str, max_queries: int = 100) -> List[Dict[str, Any]]:
-    """Load test queries from JSON file (legacy function for backward compatibility)"""
+    """Load test queries from JSONL file (legacy function for backward compatibility)"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            queries = data.get('queries', [])
-            return queries[:max_queries]
+        queries = []
+        with open(file_path, 'rb') as f:
+            for line in f:
+                if len(queries) >= max_queries:
+                    break
+                if line.strip():
+                    queries.append(orjson.loads(line))
+        return queries
     except FileNotFoundError:
         print(f"Error: File {file_path} not found!")
         return []
@@ -180,7 +182,7 @@ def run_single_test(query_info: Dict[str, Any], workflow) -> Dict[str, Any]:
             'processing_time': 0.0
         }
 
-def evaluate_agent_decisions(test_file_path: str = "evaluation/test_queries_review.json", max_students: int = 10) -> Dict[str, Any]:
+def evaluate_agent_decisions(test_file_path: str = "evaluation/test_queries_review.jsonl", max_students: int = 10) -> Dict[str, Any]:
     """Evaluate PEN agent decisions against expected review labels"""
     
     print("Loading test queries...")
@@ -373,8 +375,9 @@ def print_evaluation_report(analysis: Dict[str, Any]):
 def save_results(analysis: Dict[str, Any], output_file: str = "evaluation/agent_evaluation_results.json"):
     """Save evaluation results to JSON file"""
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(analysis, f, indent=2, ensure_ascii=False, default=str)
+        # OPT_NON_STR_KEYS writes non-string keys as strings, like json.dump did
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(analysis, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         print(f"\nResults saved to {output_file}")
     except Exception as e:
         print(f"Error saving results: {e}")
@@ -385,7 +388,7 @@ def main():
     print("-" * 40)
     
     # Configuration
-    test_file = "evaluation/test_queries_review.json"
+    test_file = "evaluation/test_queries_review.jsonl"
     max_students = 10  # Test first 10 students instead of 100 queries
     
     print(f"Test file: {test_file}")
@@ -20,11 +20,11 @@ def normalize_label(label: str) -> str:
     return label
 
 def load_queries(test_query_path: Path):
-    """Load queries from test_queries_review.json"""
-    data = json.loads(test_query_path.read_text(encoding="utf-8"))
-    queries = data.get("queries", [])
+    """Load queries from test_queries_review.jsonl (one query per line)"""
+    with test_query_path.open(encoding="utf-8") as f:
+        queries = [json.loads(line) for line in f if line.strip()]
     if not queries:
-        raise ValueError("No queries found in test_queries_review.json (missing 'queries').")
+        raise ValueError("No queries found in test_queries_review.jsonl.")
     return queries
 
 def group_by_student_ordered(queries):
@@ -74,7 +74,7 @@ def build_examples_from_groups(groups):
     return examples
 
 def main(
-    input_path="app/fine_tune/test_queries_review.json",
+    input_path="app/fine_tune/test_queries_review.jsonl",
     out_dir="finetune_data",
     test_students=10,
     val_students=10,